@@ -1,34 +1,617 @@
 import os
+import re
+import json
+import hashlib
+import uuid
+import unicodedata
 import requests
+import httpx
 from gtts import gTTS
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import heapq
 from io import BytesIO
 from pydub import AudioSegment
 import speech_recognition as sr
 import tempfile
 from deep_translator import GoogleTranslator
+from langdetect import DetectorFactory, detect_langs, LangDetectException
+from deep_translator import constants as deep_translator_constants
+from deep_translator.exceptions import RequestError as TranslatorRequestError, TooManyRequests
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    BasePersistence,
+    PersistenceInput,
     filters
 )
 from fastapi import FastAPI, Request
 import uvicorn
 import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 import asyncpg
 import asyncio
+import time
+import random
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from fastapi.responses import JSONResponse
+
+# Корзины гистограмм задержек, мс
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class LatencyHistogram:
+    """Гистограмма задержек (мс) с оценкой перцентилей по корзинам."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя — "+inf"
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float):
+        self.counts[bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает q-й перцентиль."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            cumulative += n
+            if cumulative >= target:
+                return float(self.buckets[i]) if i < len(self.buckets) else self.max_ms
+        return self.max_ms
+
+    def snapshot(self) -> dict:
+        buckets = {f"le_{b}": n for b, n in zip(self.buckets, self.counts)}
+        buckets["+inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 2),
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "buckets": buckets,
+        }
+
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Настройки пула соединений PostgreSQL
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "5"))  # секунды
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "10"))  # секунды
+
+db_pool = None
+
+# Отдельный маленький пул под advisory lock клонирования: держатель блокировки
+# занимает соединение на всё клонирование (до минуты), и общий пул от этого страдать не должен
+CLONE_LOCK_POOL_SIZE = int(os.getenv("CLONE_LOCK_POOL_SIZE", "3"))
+clone_lock_pool = None
+
+# Метрики пула (отдаются через /metrics)
+DB_POOL_METRICS = {
+    "acquired": 0,
+    "in_use": 0,
+    "acquire_timeouts": 0,
+    "acquire_wait_ms_total": 0.0,
+    "acquire_wait_ms_max": 0.0,
+}
+DB_POOL_WAIT = LatencyHistogram()
+
 app_fastapi = FastAPI()
 
-# Подключение к БД
-async def get_db():
-    return await asyncpg.connect(os.getenv("DATABASE_URL"))
+
+class TTLCache:
+    """Ограниченный по размеру LRU-кеш с TTL и счётчиками попаданий."""
+
+    MISSING = object()
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=MISSING):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        if self._data.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class SingleFlight:
+    """Склеивает одновременные вызовы с одинаковым ключом в один.
+
+    Первый вызов запускает fn() как задачу, остальные ждут её результат.
+    shield() — чтобы отмена одного ожидающего не отменяла общую задачу.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def __len__(self):
+        return len(self._inflight)
+
+
+# Кеш premium-статуса: user_id -> bool.
+# Все записи в premium_users сразу инвалидируют ключ.
+PREMIUM_CACHE_SIZE = int(os.getenv("PREMIUM_CACHE_SIZE", "10000"))
+PREMIUM_CACHE_TTL = float(os.getenv("PREMIUM_CACHE_TTL", "300"))  # секунды
+premium_cache = TTLCache(PREMIUM_CACHE_SIZE, PREMIUM_CACHE_TTL)
+
+# Кеш клонированных голосов: user_id -> {"voice_id", "source_lang", "target_lang"} или None
+VOICE_CACHE_SIZE = int(os.getenv("VOICE_CACHE_SIZE", "10000"))
+VOICE_CACHE_TTL = float(os.getenv("VOICE_CACHE_TTL", "600"))  # секунды
+voice_cache = TTLCache(VOICE_CACHE_SIZE, VOICE_CACHE_TTL)
+
+class StaleUserSet:
+    """user_id, чьи user_data поменял другой воркер.
+
+    Повторяет интерфейс кеша (invalidate/clear), чтобы подключаться к
+    INVALIDATION_CACHES. clear() помечает устаревшими сразу всех.
+    """
+
+    def __init__(self):
+        self._stale = set()
+        self._epoch = 0
+        self._checked = {}  # user_id -> epoch последней проверки
+
+    def invalidate(self, key):
+        self._stale.add(key)
+
+    def clear(self):
+        self._stale.clear()
+        self._epoch += 1
+
+    def pop(self, key) -> bool:
+        """True, если данные пользователя надо перечитать (флаг при этом снимается)."""
+        stale = key in self._stale or self._checked.get(key, 0) != self._epoch
+        self._stale.discard(key)
+        self._checked[key] = self._epoch
+        return stale
+
+
+user_data_stale = StaleUserSet()
+
+# Межпроцессная инвалидация кешей: каждый воркер слушает этот канал
+CACHE_INVALIDATION_CHANNEL = "cache_invalidation"
+INVALIDATION_CACHES = {
+    "premium": premium_cache,
+    "voice": voice_cache,
+    "user_data": user_data_stale,
+}
+# Свои же NOTIFY воркер пропускает — локально всё уже сброшено
+WORKER_ID = uuid.uuid4().hex
+
+
+class PoolExhaustedError(Exception):
+    """Не удалось получить соединение из пула за DB_ACQUIRE_TIMEOUT."""
+
+
+# Подключение к БД — всегда через общий пул
+@asynccontextmanager
+async def db_conn():
+    """Берёт соединение из пула с таймаутом и считает метрики ожидания."""
+    if db_pool is None:
+        raise RuntimeError("Database pool is not initialized (init_db() not called)")
+
+    started = time.perf_counter()
+    try:
+        conn = await db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        DB_POOL_METRICS["acquire_timeouts"] += 1
+        print(f"❌ DB pool exhausted: no connection within {DB_ACQUIRE_TIMEOUT}s "
+              f"(max_size={DB_POOL_MAX_SIZE}, in_use={DB_POOL_METRICS['in_use']})")
+        raise PoolExhaustedError(f"no DB connection within {DB_ACQUIRE_TIMEOUT}s")
+
+    waited_ms = (time.perf_counter() - started) * 1000
+    DB_POOL_METRICS["acquired"] += 1
+    DB_POOL_METRICS["acquire_wait_ms_total"] += waited_ms
+    DB_POOL_METRICS["acquire_wait_ms_max"] = max(DB_POOL_METRICS["acquire_wait_ms_max"], waited_ms)
+    DB_POOL_WAIT.observe(waited_ms)
+    DB_POOL_METRICS["in_use"] += 1
+    try:
+        yield conn
+    finally:
+        DB_POOL_METRICS["in_use"] -= 1
+        await db_pool.release(conn)
+
+
+# ========== Реестр SQL-запросов ==========
+# Все «горячие» запросы — здесь, по именам. asyncpg готовит параметризованный
+# запрос один раз на соединение и дальше берёт его из statement cache
+# (DB_STATEMENT_CACHE_SIZE), так что каждый запрос реестра prepare'ится
+# единожды на каждое соединение пула.
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "200"))
+
+QUERIES = {
+    "is_premium": """
+        SELECT user_id FROM premium_users WHERE user_id = $1;
+    """,
+    "user_state": """
+        SELECT p.user_id IS NOT NULL AS is_premium,
+               v.voice_id, v.source_lang, v.target_lang
+        FROM (SELECT $1::BIGINT AS user_id) u
+        LEFT JOIN premium_users p ON p.user_id = u.user_id
+        LEFT JOIN cloned_voices v ON v.user_id = u.user_id;
+    """,
+    "get_cloned_voice": """
+        SELECT voice_id, source_lang, target_lang
+        FROM cloned_voices
+        WHERE user_id = $1;
+    """,
+    "clone_lock_try": """
+        SELECT pg_try_advisory_lock($1::bigint);
+    """,
+    "clone_unlock": """
+        SELECT pg_advisory_unlock($1::bigint);
+    """,
+    "save_cloned_voice": """
+        INSERT INTO cloned_voices (user_id, voice_id, source_lang, target_lang)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (user_id) DO UPDATE SET
+            voice_id = EXCLUDED.voice_id,
+            source_lang = EXCLUDED.source_lang,
+            target_lang = EXCLUDED.target_lang,
+            created_at = NOW();
+    """,
+    "delete_cloned_voice": """
+        DELETE FROM cloned_voices WHERE user_id = $1
+        RETURNING voice_id;
+    """,
+    "add_premium": """
+        INSERT INTO premium_users (user_id)
+        VALUES ($1)
+        ON CONFLICT DO NOTHING;
+    """,
+    "remove_premium": """
+        DELETE FROM premium_users
+        WHERE user_id = $1;
+    """,
+    "premium_activate": """
+        INSERT INTO premium_users (user_id, is_active, purchase_date)
+        VALUES ($1, TRUE, NOW())
+        ON CONFLICT (user_id) DO UPDATE
+            SET is_active = TRUE,
+                purchase_date = NOW(),
+                cancel_date = NULL,
+                access_expires_at = NULL;
+    """,
+    "premium_cancel": """
+        UPDATE premium_users
+        SET is_active = FALSE,
+            cancel_date = NOW(),
+            access_expires_at = $1
+        WHERE user_id = $2;
+    """,
+    "premium_expire_all": """
+        DELETE FROM premium_users
+        WHERE is_active = FALSE
+        AND access_expires_at <= NOW()
+        RETURNING user_id;
+    """,
+    "premium_expire_users": """
+        DELETE FROM premium_users
+        WHERE user_id = ANY($1::BIGINT[])
+        AND is_active = FALSE
+        AND access_expires_at <= NOW()
+        RETURNING user_id;
+    """,
+    "premium_pending_expirations": """
+        SELECT user_id, access_expires_at FROM premium_users
+        WHERE is_active = FALSE
+        AND access_expires_at IS NOT NULL;
+    """,
+    "consume_quota": """
+        INSERT INTO usage_quotas (user_id, feature, used, quota_limit)
+        VALUES ($1, $2, 1, $3)
+        ON CONFLICT (user_id, feature) DO UPDATE
+            SET used = usage_quotas.used + 1,
+                quota_limit = EXCLUDED.quota_limit,
+                updated_at = NOW()
+            WHERE usage_quotas.used < EXCLUDED.quota_limit
+        RETURNING used;
+    """,
+    "refund_quota": """
+        UPDATE usage_quotas
+        SET used = used - 1,
+            updated_at = NOW()
+        WHERE user_id = $1 AND feature = $2 AND used > 0
+        RETURNING used;
+    """,
+    "user_data_load": """
+        SELECT user_id, data FROM bot_user_data;
+    """,
+    "user_data_get": """
+        SELECT data FROM bot_user_data WHERE user_id = $1;
+    """,
+    "user_data_upsert": """
+        INSERT INTO bot_user_data (user_id, data, updated_at)
+        VALUES ($1, $2::jsonb, NOW())
+        ON CONFLICT (user_id) DO UPDATE SET
+            data = (bot_user_data.data - $3::text[]) || EXCLUDED.data,
+            updated_at = NOW();
+    """,
+    "user_data_delete": """
+        DELETE FROM bot_user_data WHERE user_id = $1;
+    """,
+    "cache_notify": """
+        SELECT pg_notify($1, $2);
+    """,
+    "translation_get": """
+        SELECT translated FROM translation_cache
+        WHERE cache_key = $1 AND created_at > NOW() - make_interval(secs => $2);
+    """,
+    "translation_put": """
+        INSERT INTO translation_cache (cache_key, source_lang, target_lang, translated)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (cache_key) DO UPDATE SET translated = EXCLUDED.translated, created_at = NOW();
+    """,
+    "translation_prune": """
+        DELETE FROM translation_cache WHERE created_at < NOW() - make_interval(secs => $1);
+    """,
+    "file_id_get": """
+        SELECT file_id FROM telegram_file_ids
+        WHERE content_key = $1 AND created_at > NOW() - make_interval(secs => $2);
+    """,
+    "file_id_put": """
+        INSERT INTO telegram_file_ids (content_key, file_id, size_bytes)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (content_key) DO UPDATE SET file_id = EXCLUDED.file_id, created_at = NOW();
+    """,
+    "file_id_delete": """
+        DELETE FROM telegram_file_ids WHERE content_key = $1;
+    """,
+    "file_id_prune": """
+        DELETE FROM telegram_file_ids WHERE created_at < NOW() - make_interval(secs => $1);
+    """,
+}
+
+
+def _params_shape(args) -> str:
+    """Типы параметров без значений — чтобы не писать в лог персональные данные."""
+    parts = []
+    for arg in args:
+        if isinstance(arg, (list, tuple)):
+            parts.append(f"{type(arg).__name__}[{len(arg)}]")
+        else:
+            parts.append(type(arg).__name__)
+    return ", ".join(parts)
+
+
+class QueryRegistry:
+    """Выполняет именованные запросы из QUERIES, замеряет и логирует медленные."""
+
+    def __init__(self, queries: dict, slow_ms: float):
+        self.queries = queries
+        self.slow_ms = slow_ms
+        self.latency = {name: LatencyHistogram() for name in queries}
+
+    async def _run(self, conn, method: str, name: str, *args):
+        sql = self.queries[name]
+        started = time.perf_counter()
+        try:
+            return await getattr(conn, method)(sql, *args)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.latency[name].observe(elapsed_ms)
+            if elapsed_ms >= self.slow_ms:
+                if method == "executemany":
+                    shape = f"{len(args[0])} rows"
+                else:
+                    shape = _params_shape(args)
+                print(f"🐢 Slow query '{name}' ({method}): {elapsed_ms:.1f} ms, params: ({shape})")
+
+    async def fetch(self, conn, name: str, *args):
+        return await self._run(conn, "fetch", name, *args)
+
+    async def fetchrow(self, conn, name: str, *args):
+        return await self._run(conn, "fetchrow", name, *args)
+
+    async def fetchval(self, conn, name: str, *args):
+        return await self._run(conn, "fetchval", name, *args)
+
+    async def execute(self, conn, name: str, *args):
+        return await self._run(conn, "execute", name, *args)
+
+    async def executemany(self, conn, name: str, rows):
+        return await self._run(conn, "executemany", name, rows)
+
+    def metrics(self) -> dict:
+        return {name: hist.snapshot() for name, hist in self.latency.items() if hist.count}
+
+
+queries = QueryRegistry(QUERIES, SLOW_QUERY_MS)
+
+
+def get_db_pool_metrics():
+    """Снимок метрик пула для /metrics."""
+    metrics = dict(DB_POOL_METRICS)
+    if db_pool is not None:
+        metrics["size"] = db_pool.get_size()
+        metrics["idle"] = db_pool.get_idle_size()
+    metrics["min_size"] = DB_POOL_MIN_SIZE
+    metrics["max_size"] = DB_POOL_MAX_SIZE
+    metrics["wait"] = DB_POOL_WAIT.snapshot()
+    return metrics
+
+
+async def notify_cache_invalidation(conn, kind: str, user_ids, evict_local: bool = True):
+    """Сбрасывает ключи локально и рассылает NOTIFY остальным воркерам.
+
+    Вызывается на том же соединении, что и запись: при транзакции
+    NOTIFY уйдёт только после COMMIT. evict_local=False — когда локальная
+    копия и есть источник записи (user_data).
+    """
+    user_ids = list(user_ids)
+    if evict_local:
+        cache = INVALIDATION_CACHES[kind]
+        for uid in user_ids:
+            cache.invalidate(uid)
+
+    # payload NOTIFY ограничен 8000 байт — режем на пачки
+    for i in range(0, len(user_ids), 500):
+        payload = json.dumps({"kind": kind, "user_ids": user_ids[i:i + 500], "origin": WORKER_ID})
+        await queries.execute(conn, "cache_notify", CACHE_INVALIDATION_CHANNEL, payload)
+
+
+class CacheInvalidationListener:
+    """Держит отдельное LISTEN-соединение из пула и сбрасывает кеши по NOTIFY."""
+
+    def __init__(self):
+        self._conn = None
+        self._stopping = False
+        self.metrics = {"received": 0, "evicted": 0, "reconnects": 0}
+
+    async def start(self):
+        self._stopping = False
+        self._conn = await db_pool.acquire()
+        await self._conn.add_listener(CACHE_INVALIDATION_CHANNEL, self._on_notify)
+        self._conn.add_termination_listener(self._on_terminated)
+        print(f"📡 Listening for cache invalidations on '{CACHE_INVALIDATION_CHANNEL}'")
+
+    async def stop(self):
+        self._stopping = True
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        try:
+            await conn.remove_listener(CACHE_INVALIDATION_CHANNEL, self._on_notify)
+        finally:
+            await db_pool.release(conn)
+
+    def _on_notify(self, conn, pid, channel, payload):
+        self.metrics["received"] += 1
+        try:
+            data = json.loads(payload)
+            cache = INVALIDATION_CACHES[data["kind"]]
+        except (ValueError, KeyError) as e:
+            print(f"⚠️ Bad invalidation payload {payload!r}: {e}")
+            return
+        if data.get("origin") == WORKER_ID:
+            return
+        for uid in data["user_ids"]:
+            cache.invalidate(uid)
+            self.metrics["evicted"] += 1
+
+    def _on_terminated(self, conn):
+        if self._stopping:
+            return
+        print("⚠️ Cache invalidation connection lost — reconnecting")
+        asyncio.get_running_loop().create_task(self._reconnect(conn))
+
+    async def _reconnect(self, dead_conn):
+        try:
+            await db_pool.release(dead_conn)
+        except Exception:
+            pass
+        self._conn = None
+        # Пока соединения не было, события могли потеряться
+        for cache in INVALIDATION_CACHES.values():
+            cache.clear()
+
+        delay = 1
+        while not self._stopping:
+            try:
+                await self.start()
+                self.metrics["reconnects"] += 1
+                return
+            except Exception as e:
+                print(f"❌ Cache invalidation reconnect failed: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+
+
+cache_listener = CacheInvalidationListener()
+
+
+@app_fastapi.get("/metrics")
+async def metrics_endpoint():
+    return {
+        "db_pool": get_db_pool_metrics(),
+        "db_queries": queries.metrics(),
+        "premium_cache": premium_cache.stats(),
+        "voice_cache": voice_cache.stats(),
+        "cache_invalidation": cache_listener.metrics,
+        "synthesis": get_synth_metrics(),
+        "synthesis_cache": synth_cache.stats(),
+        "telegram_file_ids": file_id_store.stats(),
+        "voice_output": get_voice_output_metrics(),
+        "schedulers": {name: sched.stats() for name, sched in schedulers.items()},
+        "circuit_breakers": {name: breaker.stats() for name, breaker in breakers.items()},
+        "translation_cache": translation_cache.stats(),
+        "translation_pool": translation_executor.stats(),
+        "translation_batching": translation_batcher.stats(),
+        "language_detection": get_langdetect_metrics(),
+        "persistence": user_data_persistence.metrics,
+        "premium_expiry": {"pending": premium_expiry.pending_count()},
+    }
 
 
 # ========== 1) Покупка Premium ==========
@@ -43,20 +626,15 @@ async def gumroad_purchase(request: Request):
 
     user_id = int(user_id)
 
-    db = await get_db()
-
     # Сохраняем Premium
-    await db.execute("""
-        INSERT INTO premium_users (user_id, is_active, purchase_date)
-        VALUES ($1, TRUE, NOW())
-        ON CONFLICT (user_id) DO UPDATE
-            SET is_active = TRUE,
-                purchase_date = NOW(),
-                cancel_date = NULL,
-                access_expires_at = NULL;
-    """, user_id)
-
-    await db.close()
+    try:
+        async with db_conn() as db:
+            await queries.execute(db, "premium_activate", user_id)
+            await notify_cache_invalidation(db, "premium", [user_id])
+        premium_expiry.cancel(user_id)
+    except PoolExhaustedError:
+        # 503 — Gumroad повторит вебхук позже
+        return JSONResponse(status_code=503, content={"status": "error", "msg": "database busy"})
 
     # Отправить сообщение пользователю в Telegram
     text = (
@@ -89,189 +667,2108 @@ async def gumroad_cancel(request: Request):
 
     user_id = int(user_id)
 
-    next_charge = data.get("next_charge_date")  # формат: "2025-01-18T00:00:00Z"
+    next_charge = data.get("next_charge_date")  # формат: "2025-01-18T00:00:00Z"
+
+    if next_charge:
+        # колонка TIMESTAMP без зоны — храним naive UTC
+        expires = datetime.fromisoformat(next_charge.replace("Z", "+00:00"))
+        expires = expires.astimezone(timezone.utc).replace(tzinfo=None)
+    else:
+        # если не пришло — деактивируем мгновенно
+        expires = datetime.utcnow()
+
+    try:
+        async with db_conn() as db:
+            await queries.execute(db, "premium_cancel", expires, user_id)
+            await notify_cache_invalidation(db, "premium", [user_id])
+        premium_expiry.schedule(user_id, expires)
+    except PoolExhaustedError:
+        return JSONResponse(status_code=503, content={"status": "error", "msg": "database busy"})
+
+    # сообщение пользователю
+    msg = (
+        "❌ *Premium Subscription Cancelled*\n\n"
+        f"Your Premium access will remain active until:\n"
+        f"*{expires.strftime('%Y-%m-%d %H:%M')}*\n\n"
+        "After this date, your account will return to the free plan.\n\n"
+        "Thank you for being with us 💙"
+    )
+
+    await application.bot.send_message(
+        chat_id=user_id,
+        text=msg,
+        parse_mode="Markdown"
+    )
+
+    return {"status": "ok"}
+
+# ========== Рассылка с глобальным rate limit ==========
+# Telegram: ~30 сообщений/сек на бота в разные чаты — держим запас
+TELEGRAM_BROADCAST_RATE = float(os.getenv("TELEGRAM_BROADCAST_RATE", "25"))
+
+
+class AsyncRateLimiter:
+    """Token bucket: не больше rate событий в секунду (burst до capacity)."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+telegram_rate_limiter = AsyncRateLimiter(TELEGRAM_BROADCAST_RATE)
+
+
+async def notify_users(user_ids, text: str):
+    """Шлёт text всем user_ids параллельно под общим rate limit.
+
+    Ошибка одного пользователя (бот заблокирован и т.п.) не прерывает рассылку.
+    Возвращает количество доставленных сообщений.
+    """
+    async def send(uid):
+        for attempt in range(2):
+            await telegram_rate_limiter.acquire()
+            try:
+                await application.bot.send_message(chat_id=uid, text=text)
+                return True
+            except RetryAfter as e:
+                # Telegram просит подождать — одна повторная попытка
+                await asyncio.sleep(e.retry_after)
+            except Forbidden:
+                return False  # пользователь заблокировал бота
+            except Exception as e:
+                print(f"⚠️ Notify error for {uid}: {e}")
+                return False
+        return False
+
+    results = await asyncio.gather(*(send(uid) for uid in user_ids))
+    return sum(results)
+
+
+async def deactivate_expired_premium(user_ids=None):
+    """Удаляет истёкший premium и уведомляет пользователей.
+
+    user_ids=None — сверка по всей таблице (по частичному индексу),
+    иначе проверяются только переданные пользователи.
+    """
+    # Один DELETE ... RETURNING вместо SELECT + DELETE на каждую строку
+    async with db_conn() as db:
+        if user_ids is None:
+            rows = await queries.fetch(db, "premium_expire_all")
+        else:
+            rows = await queries.fetch(db, "premium_expire_users", list(user_ids))
+
+        expired = [row["user_id"] for row in rows]
+        if expired:
+            await notify_cache_invalidation(db, "premium", expired)
+
+    premium_expiry.forget(expired)
+
+    if expired:
+        # уведомляем
+        delivered = await notify_users(expired, "⏳ Premium has ended.")
+        print(f"⏳ Premium expired for {len(expired)} users, notified {delivered}")
+
+    return expired
+
+
+# ========== Точное расписание окончания Premium ==========
+PREMIUM_RECONCILE_INTERVAL = float(os.getenv("PREMIUM_RECONCILE_INTERVAL", "3600"))  # секунды
+# Часы БД могут отставать от часов бота: не удалённых DELETE'ом пробуем ещё раз
+PREMIUM_EXPIRY_RETRY_DELAY = float(os.getenv("PREMIUM_EXPIRY_RETRY_DELAY", "5"))  # секунды
+PREMIUM_EXPIRY_MAX_RETRIES = 3
+
+
+def _as_utc(dt: datetime) -> datetime:
+    """TIMESTAMP из БД приходит naive (UTC) — делаем aware для JobQueue."""
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+class PremiumExpiryScheduler:
+    """Мин-куча (access_expires_at, user_id) и одна JobQueue-задача на ближайший срок.
+
+    При перепланировании старая запись остаётся в куче и пропускается:
+    актуальный срок каждого пользователя хранится в self._expires.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._expires = {}  # user_id -> aware UTC datetime
+        self._job = None
+        self._job_at = None
+        self._job_queue = None
+        self._inflight = set()  # user_id, которые сейчас удаляет _fire
+        self._retries = {}  # user_id -> число повторов
+
+    async def start(self, job_queue):
+        """Загружает предстоящие окончания из БД и ставит первую задачу."""
+        self._job_queue = job_queue
+        async with db_conn() as conn:
+            rows = await queries.fetch(conn, "premium_pending_expirations")
+        for row in rows:
+            self._push(row["user_id"], row["access_expires_at"])
+        self._rearm()
+        print(f"⏳ Premium expiry scheduler loaded {len(self._expires)} pending expirations")
+
+    def schedule(self, user_id: int, expires_at: datetime):
+        self._push(user_id, expires_at)
+        self._rearm()
+
+    def cancel(self, user_id: int):
+        self._inflight.discard(user_id)
+        self._retries.pop(user_id, None)
+        if self._expires.pop(user_id, None) is not None:
+            self._rearm()
+
+    def forget(self, user_ids):
+        """Убирает пользователей, уже обработанных сверкой."""
+        removed = []
+        for uid in user_ids:
+            self._inflight.discard(uid)
+            self._retries.pop(uid, None)
+            if self._expires.pop(uid, None) is not None:
+                removed.append(uid)
+        if removed:
+            self._rearm()
+
+    def pending_count(self) -> int:
+        return len(self._expires)
+
+    def _push(self, user_id: int, expires_at: datetime):
+        self._inflight.discard(user_id)
+        expires_at = _as_utc(expires_at)
+        self._expires[user_id] = expires_at
+        heapq.heappush(self._heap, (expires_at, user_id))
+
+    def _peek(self):
+        # Выкидываем устаревшие записи с вершины кучи
+        while self._heap:
+            expires_at, uid = self._heap[0]
+            if self._expires.get(uid) == expires_at:
+                return expires_at
+            heapq.heappop(self._heap)
+        return None
+
+    def _rearm(self):
+        if self._job_queue is None:
+            return
+        next_at = self._peek()
+        if self._job is not None and self._job_at == next_at:
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
+            self._job_at = None
+        if next_at is None:
+            return
+        # Срок мог пройти, пока бот лежал: APScheduler молча пропускает задачи
+        # в прошлом дальше misfire_grace_time, поэтому не ставим время раньше «сейчас»
+        when = max(next_at, datetime.now(timezone.utc))
+        self._job = self._job_queue.run_once(
+            self._fire,
+            when=when,
+            name="premium_expiry",
+            job_kwargs={"misfire_grace_time": None},
+        )
+        self._job_at = next_at
+
+    async def _fire(self, context: ContextTypes.DEFAULT_TYPE):
+        self._job = None
+        self._job_at = None
+        now = datetime.now(timezone.utc)
+        due = []
+        while True:
+            next_at = self._peek()
+            if next_at is None or next_at > now:
+                break
+            _, uid = heapq.heappop(self._heap)
+            self._expires.pop(uid, None)
+            due.append(uid)
+
+        if due:
+            self._inflight.update(due)
+            try:
+                expired = set(await deactivate_expired_premium(due))
+            except Exception as e:
+                print("❌ Premium expiry error:", e)
+                expired = set()
+
+            # DELETE сравнивает с NOW() базы: если её часы отстают или запрос упал,
+            # пользователь не удалён — ставим повтор, а не забываем до часовой сверки.
+            # Отменённые/продлённые за это время уже убраны из _inflight.
+            retry_at = now + timedelta(seconds=PREMIUM_EXPIRY_RETRY_DELAY)
+            for uid in due:
+                if uid in expired or uid not in self._inflight:
+                    self._retries.pop(uid, None)
+                    continue
+                attempts = self._retries.get(uid, 0) + 1
+                if attempts > PREMIUM_EXPIRY_MAX_RETRIES:
+                    # дальше — периодическая сверка
+                    self._retries.pop(uid, None)
+                    continue
+                self._retries[uid] = attempts
+                self._push(uid, retry_at)
+            self._inflight.difference_update(due)
+        self._rearm()
+
+
+premium_expiry = PremiumExpiryScheduler()
+
+
+# 🔁 Job для JobQueue: дешёвая сверка на случай пропущенных событий
+async def check_expired_premium_job(context: ContextTypes.DEFAULT_TYPE):
+    # Заодно чистим устаревшие переводы и file_id в БД (ошибки prune не пробрасывают)
+    await translation_cache.prune()
+    await file_id_store.prune()
+    await deactivate_expired_premium()
+
+async def init_db():
+    """Создаёт подключение к БД и таблицы, если их нет."""
+    global db_pool, clone_lock_pool
+    db_pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+    )
+    clone_lock_pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=0,
+        max_size=CLONE_LOCK_POOL_SIZE,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+    )
+
+    async with db_conn() as conn:
+
+        # Таблица премиум-пользователей
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS premium_users (
+                user_id BIGINT PRIMARY KEY,
+                is_active BOOLEAN DEFAULT TRUE,
+                purchase_date TIMESTAMP,
+                cancel_date TIMESTAMP,
+                access_expires_at TIMESTAMP
+            );
+
+        """)
+
+        # Частичный индекс для сверки истёкших подписок
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS premium_users_expiry_idx
+            ON premium_users (access_expires_at)
+            WHERE is_active = FALSE;
+        """)
+
+        # Таблица клонированных голосов
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS cloned_voices (
+                user_id BIGINT PRIMARY KEY,
+                voice_id TEXT NOT NULL,
+                source_lang TEXT,
+                target_lang TEXT,
+                created_at TIMESTAMP DEFAULT NOW()
+            );
+        """)
+
+        # Таблица бесплатных лимитов
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage_quotas (
+                user_id BIGINT NOT NULL,
+                feature TEXT NOT NULL,
+                used INTEGER NOT NULL DEFAULT 0,
+                quota_limit INTEGER NOT NULL,
+                updated_at TIMESTAMP DEFAULT NOW(),
+                PRIMARY KEY (user_id, feature)
+            );
+        """)
+
+        # Таблица user_data (PostgresPersistence)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS bot_user_data (
+                user_id BIGINT PRIMARY KEY,
+                data JSONB NOT NULL DEFAULT '{}'::jsonb,
+                updated_at TIMESTAMP DEFAULT NOW()
+            );
+        """)
+
+        # Таблица file_id уже загруженных в Telegram аудио
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS telegram_file_ids (
+                content_key TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                size_bytes INTEGER,
+                created_at TIMESTAMP DEFAULT NOW()
+            );
+        """)
+
+        # Индекс для чистки старых file_id
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS telegram_file_ids_created_idx
+            ON telegram_file_ids (created_at);
+        """)
+
+        # Таблица кеша переводов (второй уровень TranslationCache)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS translation_cache (
+                cache_key TEXT PRIMARY KEY,
+                source_lang TEXT NOT NULL,
+                target_lang TEXT NOT NULL,
+                translated TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT NOW()
+            );
+        """)
+
+        # Индекс для чистки устаревших переводов
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS translation_cache_created_idx
+            ON translation_cache (created_at);
+        """)
+
+    print("🗄 PostgreSQL initialized. premium_users, cloned_voices, bot_user_data, telegram_file_ids & translation_cache tables ready.")
+
+async def save_cloned_voice(user_id: int, voice_id: str, src: str, tgt: str):
+    async with db_conn() as conn:
+        await queries.execute(conn, "save_cloned_voice", user_id, voice_id, src, tgt)
+        await notify_cache_invalidation(conn, "voice", [user_id])
+
+async def get_cloned_voice(user_id: int):
+    """Клонированный голос пользователя (через voice_cache) или None."""
+    cached = voice_cache.get(user_id)
+    if cached is not TTLCache.MISSING:
+        return cached
+
+    async with db_conn() as conn:
+        row = await queries.fetchrow(conn, "get_cloned_voice", user_id)
+    voice = dict(row) if row else None
+    voice_cache.set(user_id, voice)
+    return voice
+
+async def delete_cloned_voice(user_id: int):
+    """Удаляет клонированный голос (используется если нужно сбросить)."""
+    async with db_conn() as conn:
+        voice_id = await queries.fetchval(conn, "delete_cloned_voice", user_id)
+        await notify_cache_invalidation(conn, "voice", [user_id])
+
+    # Синтезы удалённого голоса больше не нужны
+    if voice_id:
+        await synth_cache.invalidate_voice(voice_id)
+
+async def add_premium(user_id: int):
+    """Добавляет пользователя в таблицу Premium."""
+    async with db_conn() as conn:
+        await queries.execute(conn, "add_premium", user_id)
+        await notify_cache_invalidation(conn, "premium", [user_id])
+
+async def remove_premium(user_id: int):
+    """Удаляет пользователя из таблицы Premium."""
+    async with db_conn() as conn:
+        await queries.execute(conn, "remove_premium", user_id)
+        await notify_cache_invalidation(conn, "premium", [user_id])
+    premium_expiry.cancel(user_id)
+
+
+async def is_premium(user_id: int) -> bool:
+    """Проверяет, есть ли пользователь в Premium (через premium_cache)."""
+    cached = premium_cache.get(user_id)
+    if cached is not TTLCache.MISSING:
+        return cached
+
+    async with db_conn() as conn:
+        row = await queries.fetchrow(conn, "is_premium", user_id)
+    premium_cache.set(user_id, row is not None)
+    return row is not None
+
+
+async def consume_quota(user_id: int, feature: str, limit: int):
+    """Атомарно проверяет и списывает одну попытку.
+
+    Проверка и списание — один INSERT ... ON CONFLICT DO UPDATE ... WHERE,
+    поэтому параллельные запросы (в т.ч. из разных воркеров) не могут
+    превысить лимит. Возвращает новое значение used или None, если лимит исчерпан.
+    """
+    if limit <= 0:
+        return None
+    async with db_conn() as conn:
+        return await queries.fetchval(conn, "consume_quota", user_id, feature, limit)
+
+async def refund_quota(user_id: int, feature: str):
+    """Возвращает одну попытку (после неудачного платного вызова)."""
+    async with db_conn() as conn:
+        return await queries.fetchval(conn, "refund_quota", user_id, feature)
+
+
+async def load_user_state(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> dict:
+    """Premium-статус и клонированный голос: из кешей либо одним запросом.
+
+    PTB создаёт один context на апдейт и передаёт его всем хендлерам
+    (включая preload_user из group=-1), поэтому результат храним прямо
+    на context: повторные вызовы в том же апдейте в БД не ходят.
+    """
+    state = getattr(context, "user_state", None)
+    if state is not None and state["user_id"] == user_id:
+        return state
+
+    premium = premium_cache.get(user_id)
+    voice = voice_cache.get(user_id)
+
+    if premium is TTLCache.MISSING:
+        async with db_conn() as conn:
+            row = await queries.fetchrow(conn, "user_state", user_id)
+        premium = row["is_premium"]
+        premium_cache.set(user_id, premium)
+        voice = {
+            "voice_id": row["voice_id"],
+            "source_lang": row["source_lang"],
+            "target_lang": row["target_lang"],
+        } if row["voice_id"] else None
+        voice_cache.set(user_id, voice)
+    elif voice is TTLCache.MISSING:
+        # premium уже в кеше — нужен только голос
+        voice = await get_cloned_voice(user_id)
+
+    voice = voice or {"voice_id": None, "source_lang": None, "target_lang": None}
+
+    state = {
+        "user_id": user_id,
+        "is_premium": premium,
+        "voice_id": voice["voice_id"],
+        "voice_source_lang": voice["source_lang"],
+        "voice_target_lang": voice["target_lang"],
+    }
+    context.user_state = state
+    return state
+
+
+# ========== Персистентность context.user_data ==========
+# is_premium и cloned_voice_id живут в своих таблицах и грузятся load_user_state()
+USER_DATA_TRANSIENT_KEYS = {"is_premium", "cloned_voice_id"}
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "15"))  # секунды
+
+
+class PostgresPersistence(BasePersistence):
+    """Хранит context.user_data в bot_user_data поверх общего asyncpg-пула.
+
+    PTB сам копит «грязных» пользователей и раз в update_interval вызывает
+    update_user_data для каждого из них. Здесь записи только буферизуются
+    и сбрасываются одним executemany-upsert'ом, поэтому обработка сообщений
+    не ждёт БД.
+
+    Пишутся только изменённые ключи (jsonb ||, удалённые — через -), так что
+    два воркера, меняющие разные ключи одного пользователя, не затирают друг
+    друга. После записи уходит NOTIFY "user_data", и другие воркеры перечитывают
+    строку в refresh_user_data перед следующим апдейтом этого пользователя.
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._pending = {}  # user_id -> последний снимок user_data
+        self._persisted = {}  # user_id -> то, что сейчас лежит в БД
+        self._flush_task = None
+        self.metrics = {"flushes": 0, "rows_written": 0, "flush_errors": 0, "refreshes": 0}
+
+    @staticmethod
+    def _snapshot(data: dict) -> dict:
+        # Через JSON, чтобы сравнивать с тем, что вернёт БД
+        payload = {k: v for k, v in data.items() if k not in USER_DATA_TRANSIENT_KEYS}
+        return json.loads(json.dumps(payload, default=str))
+
+    def _diff(self, user_id: int, snapshot: dict):
+        base = self._persisted.get(user_id, {})
+        changed = {k: v for k, v in snapshot.items() if k not in base or base[k] != v}
+        removed = [k for k in base if k not in snapshot]
+        return changed, removed
+
+    async def get_user_data(self):
+        async with db_conn() as conn:
+            rows = await queries.fetch(conn, "user_data_load")
+        print(f"🗄 Loaded user_data for {len(rows)} users")
+        self._persisted = {row["user_id"]: json.loads(row["data"]) for row in rows}
+        return {uid: dict(data) for uid, data in self._persisted.items()}
+
+    async def update_user_data(self, user_id: int, data: dict):
+        self._pending[user_id] = self._snapshot(data)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_pending())
+
+    async def _flush_pending(self):
+        # Даём остальным update_user_data из того же прохода попасть в буфер
+        await asyncio.sleep(0)
+        while self._pending:
+            batch, self._pending = self._pending, {}
+            rows = []
+            for uid, snapshot in batch.items():
+                changed, removed = self._diff(uid, snapshot)
+                if changed or removed:
+                    rows.append((uid, json.dumps(changed), removed))
+            if not rows:
+                continue
+            try:
+                async with db_conn() as conn:
+                    await queries.executemany(conn, "user_data_upsert", rows)
+                    await notify_cache_invalidation(
+                        conn, "user_data", [row[0] for row in rows], evict_local=False
+                    )
+            except Exception as e:
+                self.metrics["flush_errors"] += 1
+                print(f"❌ user_data flush error ({len(batch)} users): {e}")
+                # Возвращаем в буфер всё, что не успели перезаписать более новым
+                for uid, snapshot in batch.items():
+                    self._pending.setdefault(uid, snapshot)
+                return
+            for uid, snapshot in batch.items():
+                self._persisted[uid] = snapshot
+            self.metrics["flushes"] += 1
+            self.metrics["rows_written"] += len(rows)
+
+    async def drop_user_data(self, user_id: int):
+        self._pending.pop(user_id, None)
+        self._persisted.pop(user_id, None)
+        async with db_conn() as conn:
+            await queries.execute(conn, "user_data_delete", user_id)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        # Перечитываем, только если другой воркер прислал NOTIFY (или LISTEN переподключался)
+        if not user_data_stale.pop(user_id):
+            return
+        async with db_conn() as conn:
+            raw = await queries.fetchval(conn, "user_data_get", user_id)
+        fresh = json.loads(raw) if raw else {}
+        self.metrics["refreshes"] += 1
+
+        # Свои ещё не записанные изменения важнее прочитанного
+        changed, removed = self._diff(user_id, self._snapshot(user_data))
+        local_changes = set(changed) | set(removed)
+
+        for key, value in fresh.items():
+            if key not in local_changes:
+                user_data[key] = value
+        for key in list(user_data):
+            if key not in fresh and key not in local_changes and key not in USER_DATA_TRANSIENT_KEYS:
+                del user_data[key]
+        self._persisted[user_id] = fresh
+
+    async def flush(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self._flush_pending()
+
+    # chat_data / bot_data / callback_data / conversations не храним
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+
+user_data_persistence = PostgresPersistence()
+
+print(os.environ)  # или хотя бы os.environ.keys()
+# Load env vars
+TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+ELEVENLABS_API_KEY = os.getenv("ELEVEN_API_KEY")
+# Базовые URL можно подменить на mock_upstream.py для нагрузочных тестов
+ELEVENLABS_API_BASE = os.getenv("ELEVENLABS_API_BASE", "https://api.elevenlabs.io").rstrip("/")
+ELEVENLABS_VOICE_CLONE_URL = os.getenv("ELEVENLABS_VOICE_CLONE_URL", f"{ELEVENLABS_API_BASE}/v1/voices/add")
+ELEVENLABS_TTS_URL = os.getenv("ELEVENLABS_TTS_URL", ELEVENLABS_API_BASE + "/v1/text-to-speech/{voice_id}")
+ELEVENLABS_TTS_STREAM_URL = ELEVENLABS_TTS_URL + "/stream"
+GOOGLE_TRANSLATE_URL = os.getenv("GOOGLE_TRANSLATE_URL")
+GOOGLE_SPEECH_URL = os.getenv("GOOGLE_SPEECH_URL")
+if GOOGLE_TRANSLATE_URL:
+    # GoogleTranslator читает URL из этого словаря при создании
+    deep_translator_constants.BASE_URLS["GOOGLE_TRANSLATE"] = GOOGLE_TRANSLATE_URL
+ELEVENLABS_MODEL_ID = "eleven_multilingual_v2"
+# читаем product ID из переменной окружения
+GUMROAD_PRODUCT_ID = os.getenv("GUMROAD_PRODUCT_ID")
+# PREMIUM_USERS = {}   временное хранилище Premium (можно заменить на БД)
+
+DEFAULT_TARGET = os.getenv("TARGET_LANG", "en")
+application = ApplicationBuilder().token(TELEGRAM_TOKEN).persistence(user_data_persistence).build()
+
+
+# ========== Общий async HTTP-клиент (ElevenLabs) ==========
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "50"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))  # секунды
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+ELEVENLABS_SYNTH_TIMEOUT = float(os.getenv("ELEVENLABS_SYNTH_TIMEOUT", "30"))
+ELEVENLABS_CLONE_TIMEOUT = float(os.getenv("ELEVENLABS_CLONE_TIMEOUT", "60"))
+# Стриминговый endpoint отдаёт первые байты, пока остальное ещё синтезируется
+ELEVENLABS_STREAMING = os.getenv("ELEVENLABS_STREAMING", "1") == "1"
+
+# HTTP/2 — только если установлен пакет h2 (httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+http_client = httpx.AsyncClient(
+    http2=HTTP2_AVAILABLE,
+    limits=httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    ),
+    timeout=httpx.Timeout(ELEVENLABS_SYNTH_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+)
+
+DEFAULT_VOICE_SETTINGS = {
+    "stability": 0.5,
+    "similarity_boost": 0.75,
+}
+
+
+class ElevenLabsError(Exception):
+    """ElevenLabs ответил не-2xx."""
+
+    def __init__(self, status_code: int, text: str):
+        super().__init__(f"ElevenLabs error {status_code}: {text[:200]}")
+        self.status_code = status_code
+        self.text = text
+
+
+def elevenlabs_headers(**extra):
+    return {"xi-api-key": ELEVENLABS_API_KEY, **extra}
+
+
+async def warm_up_http_client():
+    """Открывает keep-alive соединение к ElevenLabs заранее (DNS + TLS)."""
+    try:
+        started = time.perf_counter()
+        r = await http_client.get(f"{ELEVENLABS_API_BASE}/v1/models", headers=elevenlabs_headers(), timeout=10)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        print(f"🔥 ElevenLabs warm-up: {r.status_code} {r.http_version} in {elapsed_ms:.0f} ms")
+    except Exception as e:
+        print(f"⚠️ ElevenLabs warm-up failed: {e}")
+
+
+# ========== Circuit breaker и повторы ==========
+# Если бэкенд лежит, не ждём таймаут в каждом хендлере: после серии ошибок
+# цепь размыкается и запросы сразу получают CircuitOpenError.
+CB_FAILURE_THRESHOLD = int(os.getenv("CB_FAILURE_THRESHOLD", "5"))
+CB_RESET_TIMEOUT = float(os.getenv("CB_RESET_TIMEOUT", "30"))  # секунды до пробного запроса
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "2"))  # повторы сверх первой попытки
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "4"))
+
+
+class CircuitOpenError(Exception):
+    """Бэкенд временно отключён circuit breaker'ом."""
+
+    def __init__(self, backend: str, retry_in: float):
+        super().__init__(f"{backend} unavailable, retry in {retry_in:.0f}s")
+        self.backend = backend
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """closed -> open после N ошибок подряд -> half_open (один пробный запрос) -> closed."""
+
+    def __init__(self, name: str, failure_threshold: int = CB_FAILURE_THRESHOLD,
+                 reset_timeout: float = CB_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.retries = 0
+        self.opened = 0
+
+    def before_call(self):
+        if self.state == "open":
+            elapsed = time.monotonic() - self.opened_at
+            if elapsed < self.reset_timeout:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self.reset_timeout - elapsed)
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self.reset_timeout)
+            self._probe_in_flight = True
+
+    def record_success(self):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+        if self.state != "closed":
+            print(f"✅ Circuit {self.name} closed")
+        self.state = "closed"
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                self.opened += 1
+                print(f"🔌 Circuit {self.name} opened after {self.consecutive_failures} failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def record_neutral(self):
+        # Ответ получен, но ошибка клиентская (4xx) — бэкенд жив
+        self._probe_in_flight = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "successes": self.successes,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "retries": self.retries,
+            "opened": self.opened,
+        }
+
+
+def is_backend_failure(exc: BaseException) -> bool:
+    """Ошибка говорит о проблеме бэкенда (а не о плохом запросе)?"""
+    if isinstance(exc, ElevenLabsError):
+        return exc.status_code >= 500 or exc.status_code == 429
+    return isinstance(exc, (
+        httpx.TransportError,
+        asyncio.TimeoutError,
+        sr.RequestError,
+        requests.exceptions.RequestException,
+        TranslatorRequestError,
+        TooManyRequests,
+    ))
+
+
+breakers = {name: CircuitBreaker(name) for name in ("elevenlabs", "recognition", "translation")}
+
+
+async def call_with_resilience(backend: str, fn, idempotent: bool = True,
+                               attempts: int = RETRY_ATTEMPTS):
+    """Вызывает fn() через circuit breaker бэкенда.
+
+    Идемпотентные вызовы повторяются до attempts раз с full-jitter backoff.
+    Неидемпотентные (клонирование голоса) выполняются ровно один раз.
+    """
+    breaker = breakers[backend]
+    max_attempts = 1 + (attempts if idempotent else 0)
+    for attempt in range(max_attempts):
+        breaker.before_call()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            breaker.record_neutral()
+            raise
+        except Exception as e:
+            if not is_backend_failure(e):
+                breaker.record_neutral()
+                raise
+            breaker.record_failure()
+            if attempt + 1 >= max_attempts:
+                raise
+            breaker.retries += 1
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            print(f"🔁 {backend} retry {attempt + 1}/{max_attempts - 1} in {delay:.2f}s: {e!r}")
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+
+# ========== Приоритетный планировщик тяжёлых задач ==========
+# Premium-пользователям обещана приоритетная обработка: у каждого бэкенда
+# ограниченный параллелизм, premium-очередь обслуживается первой,
+# а free-пользователи чередуются по кругу, чтобы один не занял всю очередь.
+SCHED_CONCURRENCY = {
+    "elevenlabs": int(os.getenv("SCHED_ELEVENLABS_CONCURRENCY", "4")),
+    "recognition": int(os.getenv("SCHED_RECOGNITION_CONCURRENCY", "4")),
+    "translation": int(os.getenv("SCHED_TRANSLATION_CONCURRENCY", "8")),
+}
+# Сколько premium-задач подряд можно выдать, пока free-очередь ждёт
+SCHED_PREMIUM_BURST = int(os.getenv("SCHED_PREMIUM_BURST", "4"))
+
+
+class PriorityScheduler:
+    """Семафор бэкенда с двумя полосами: premium (FIFO) и free (round-robin по user_id)."""
+
+    LANES = ("premium", "free")
+
+    def __init__(self, name: str, concurrency: int, premium_burst: int = SCHED_PREMIUM_BURST):
+        self.name = name
+        self.concurrency = concurrency
+        self.premium_burst = premium_burst
+        self._active = 0
+        self._premium = deque()
+        self._free = OrderedDict()  # user_id -> deque(futures)
+        self._premium_streak = 0
+        self.wait = {lane: LatencyHistogram() for lane in self.LANES}
+        self.served = {lane: 0 for lane in self.LANES}
+        self.cancelled = {lane: 0 for lane in self.LANES}
+
+    def depth(self, lane: str) -> int:
+        if lane == "premium":
+            return sum(1 for f in self._premium if not f.done())
+        return sum(1 for q in self._free.values() for f in q if not f.done())
+
+    def _pop_premium(self):
+        while self._premium:
+            fut = self._premium.popleft()
+            if not fut.done():
+                return fut
+        return None
+
+    def _pop_free(self):
+        while self._free:
+            user_id, q = next(iter(self._free.items()))
+            fut = q.popleft()
+            if q:
+                self._free.move_to_end(user_id)
+            else:
+                del self._free[user_id]
+            if not fut.done():
+                return fut
+        return None
+
+    def _next_waiter(self):
+        if self._premium_streak >= self.premium_burst:
+            fut = self._pop_free()
+            if fut is not None:
+                self._premium_streak = 0
+                return fut
+        fut = self._pop_premium()
+        if fut is not None:
+            self._premium_streak += 1
+            return fut
+        self._premium_streak = 0
+        return self._pop_free()
+
+    def _release(self):
+        fut = self._next_waiter()
+        if fut is not None:
+            # Слот переходит следующему, _active не меняется
+            fut.set_result(None)
+        else:
+            self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self, user_id, premium: bool):
+        lane = "premium" if premium else "free"
+        started = time.perf_counter()
+
+        if self._active < self.concurrency and not self._premium and not self._free:
+            self._active += 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            if premium:
+                self._premium.append(fut)
+            else:
+                self._free.setdefault(user_id, deque()).append(fut)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                self.cancelled[lane] += 1
+                if fut.done() and not fut.cancelled():
+                    # Слот уже выдан — отдаём его дальше
+                    self._release()
+                raise
+
+        self.wait[lane].observe((time.perf_counter() - started) * 1000)
+        self.served[lane] += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "active": self._active,
+            "lanes": {
+                lane: {
+                    "queued": self.depth(lane),
+                    "served": self.served[lane],
+                    "cancelled": self.cancelled[lane],
+                    "wait_ms": self.wait[lane].snapshot(),
+                }
+                for lane in self.LANES
+            },
+        }
+
+
+schedulers = {name: PriorityScheduler(name, limit) for name, limit in SCHED_CONCURRENCY.items()}
+
+
+# ========== Пул потоков для перевода ==========
+# GoogleTranslator.translate — синхронный HTTP; держим его в отдельном
+# ограниченном пуле с дедлайном на вызов, чтобы не трогать цикл событий.
+TRANSLATION_WORKERS = int(os.getenv("TRANSLATION_WORKERS", "8"))
+TRANSLATION_TIMEOUT = float(os.getenv("TRANSLATION_TIMEOUT", "10"))  # секунды
+
+
+class TranslationExecutor:
+    """Ограниченный пул потоков для GoogleTranslator.
+
+    Переводчик создаётся один раз на пару (source, target) в каждом потоке:
+    translate() пишет текст в свои параметры запроса, поэтому делить один
+    экземпляр между потоками нельзя.
+    """
+
+    def __init__(self, workers: int, timeout: float):
+        self.workers = workers
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="translate")
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.translators_created = 0
+        self.wait = LatencyHistogram()
+        self.run = LatencyHistogram()
+        self.total = LatencyHistogram()
+
+    def _translator(self, source: str, target: str) -> GoogleTranslator:
+        translators = getattr(self._local, "translators", None)
+        if translators is None:
+            translators = self._local.translators = {}
+        translator = translators.get((source, target))
+        if translator is None:
+            translator = translators[(source, target)] = GoogleTranslator(source=source, target=target)
+            with self._lock:
+                self.translators_created += 1
+        return translator
+
+    def _run(self, text: str, source: str, target: str):
+        started = time.perf_counter()
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        try:
+            return self._translator(source, target).translate(text), started
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def _on_done(self, future):
+        # Отменённая до старта задача так и не вызвала _run
+        if future.cancelled():
+            with self._lock:
+                self._queued -= 1
+
+    async def translate(self, text: str, source: str, target: str) -> str:
+        submitted = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+        future = self._pool.submit(self._run, text, source, target)
+        future.add_done_callback(self._on_done)
+
+        try:
+            result, started = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            # Поток дорабатывает в фоне, но пользователь больше не ждёт
+            self.timeouts += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+
+        finished = time.perf_counter()
+        self.completed += 1
+        self.wait.observe((started - submitted) * 1000)
+        self.run.observe((finished - started) * 1000)
+        self.total.observe((finished - submitted) * 1000)
+        return result
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "timeout_s": self.timeout,
+            "queued": self._queued,
+            "running": self._running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "translators_created": self.translators_created,
+            "wait_ms": self.wait.snapshot(),
+            "run_ms": self.run.snapshot(),
+            "total_ms": self.total.snapshot(),
+        }
+
+
+translation_executor = TranslationExecutor(TRANSLATION_WORKERS, TRANSLATION_TIMEOUT)
+
+
+async def translate_upstream(text: str, source: str, target: str,
+                             user_id: int = None, premium: bool = False) -> str:
+    """Перевод в пуле translation_executor, через планировщик и circuit breaker translation."""
+    async def attempt():
+        async with schedulers["translation"].slot(user_id, premium):
+            return await translation_executor.translate(text, source, target)
+
+    return await call_with_resilience("translation", attempt)
+
+
+# ========== Микро-батчинг переводов ==========
+# В пик много коротких текстов на одну пару языков приходят почти одновременно.
+# Собираем их за короткое окно и отправляем одним запросом: каждый текст — свой
+# абзац с номером-меткой, ответ режется обратно по меткам. Пустая строка между
+# абзацами не даёт переводчику связывать соседние тексты по контексту, а проверка
+# всех меток по порядку — отдать перевод не тому пользователю. translate_batch из
+# deep-translator не подходит — он всё равно делает по запросу на текст.
+TRANSLATION_BATCHING = os.getenv("TRANSLATION_BATCHING", "0") == "1"
+TRANSLATION_BATCH_WINDOW_MS = float(os.getenv("TRANSLATION_BATCH_WINDOW_MS", "15"))
+TRANSLATION_BATCH_MAX_ITEMS = int(os.getenv("TRANSLATION_BATCH_MAX_ITEMS", "16"))
+TRANSLATION_BATCH_MAX_CHARS = int(os.getenv("TRANSLATION_BATCH_MAX_CHARS", "3000"))
+# Метка строки должна вернуться из переводчика нетронутой, иначе батч переводится по одному
+TRANSLATION_BATCH_MARK = "[{}]"
+TRANSLATION_BATCH_MARK_RE = re.compile(r"^\s*\[\s*(\d+)\s*\]\s?(.*)$")
+
+
+class TranslationBatcher:
+    """Склеивает переводы одной пары языков, пришедшие в течение окна."""
+
+    def __init__(self, window_ms: float, max_items: int, max_chars: int):
+        self.window = window_ms / 1000
+        self.max_items = max_items
+        self.max_chars = max_chars
+        self._pending = {}  # (source, target) -> [(text, future, premium)]
+        self._chars = {}
+        self._timers = {}
+        self.batches = 0
+        self.items = 0
+        self.direct = 0
+        self.fallbacks = 0
+
+    async def translate(self, text: str, source: str, target: str,
+                        user_id: int = None, premium: bool = False) -> str:
+        # Многострочный текст нельзя однозначно разрезать обратно
+        if "\n" in text or len(text) >= self.max_chars:
+            self.direct += 1
+            return await translate_upstream(text, source, target, user_id=user_id, premium=premium)
+
+        pair = (source, target)
+        # Метка, пробел и пустая строка-разделитель тоже идут в запрос
+        size = len(text) + len(TRANSLATION_BATCH_MARK.format(self.max_items)) + 3
+        if self._chars.get(pair, 0) + size > self.max_chars:
+            self._flush(pair)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(pair, []).append((text, future, premium))
+        self._chars[pair] = self._chars.get(pair, 0) + size
+
+        if len(self._pending[pair]) >= self.max_items:
+            self._flush(pair)
+        elif pair not in self._timers:
+            self._timers[pair] = asyncio.get_running_loop().call_later(self.window, self._flush, pair)
+
+        return await future
+
+    def _flush(self, pair):
+        timer = self._timers.pop(pair, None)
+        if timer is not None:
+            timer.cancel()
+        self._chars.pop(pair, None)
+        batch = self._pending.pop(pair, None)
+        if batch:
+            asyncio.ensure_future(self._send(pair, batch))
+
+    @staticmethod
+    def _split_marked(joined: str, count: int):
+        """Режет ответ по меткам; None, если хоть одна метка потерялась или сдвинулась."""
+        lines = [line for line in (joined or "").split("\n") if line.strip()]
+        if len(lines) != count:
+            return None
+        results = []
+        for index, line in enumerate(lines):
+            match = TRANSLATION_BATCH_MARK_RE.match(line)
+            if not match or int(match.group(1)) != index:
+                return None
+            results.append(match.group(2))
+        return results
+
+    async def _send(self, pair, batch):
+        source, target = pair
+        texts = [text for text, _, _ in batch]
+        # Батч общий для нескольких пользователей: в планировщик — только полоса
+        # самого «дорогого» участника, без user_id
+        premium = any(p for _, _, p in batch)
+        self.batches += 1
+        self.items += len(batch)
+
+        try:
+            if len(texts) == 1:
+                results = [await translate_upstream(texts[0], source, target, premium=premium)]
+            else:
+                marked = "\n\n".join(
+                    f"{TRANSLATION_BATCH_MARK.format(i)} {text}" for i, text in enumerate(texts)
+                )
+                joined = await translate_upstream(marked, source, target, premium=premium)
+                results = self._split_marked(joined, len(texts))
+                if results is None:
+                    # Переводчик испортил метки или строки — переводим по одному
+                    self.fallbacks += 1
+                    results = await asyncio.gather(
+                        *(translate_upstream(text, source, target, premium=premium) for text in texts),
+                        return_exceptions=True,
+                    )
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future, _), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result.strip())
+
+    def stats(self) -> dict:
+        return {
+            "enabled": TRANSLATION_BATCHING,
+            "window_ms": self.window * 1000,
+            "batches": self.batches,
+            "items": self.items,
+            "direct": self.direct,
+            "fallbacks": self.fallbacks,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "upstream_calls_saved": self.items - self.batches,
+        }
+
+
+translation_batcher = TranslationBatcher(
+    TRANSLATION_BATCH_WINDOW_MS, TRANSLATION_BATCH_MAX_ITEMS, TRANSLATION_BATCH_MAX_CHARS
+)
+
+
+async def translate_miss(text: str, source: str, target: str,
+                         user_id: int = None, premium: bool = False) -> str:
+    """Промах кеша: через батчер, если он включён, иначе напрямую."""
+    if TRANSLATION_BATCHING:
+        return await translation_batcher.translate(text, source, target, user_id=user_id, premium=premium)
+    return await translate_upstream(text, source, target, user_id=user_id, premium=premium)
+
+
+# ========== Кеш переводов ==========
+# Частые фразы ("привет", "спасибо") переводятся заново на каждое сообщение.
+# Память — первый уровень, Postgres (по желанию) — общий для всех воркеров.
+# В БД лежит пользовательский текст, поэтому уровень выключен по умолчанию,
+# а строки старше TRANSLATION_CACHE_DB_TTL не читаются и удаляются сверкой.
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "10000"))
+TRANSLATION_CACHE_TTL = float(os.getenv("TRANSLATION_CACHE_TTL", str(24 * 3600)))
+TRANSLATION_CACHE_DB = os.getenv("TRANSLATION_CACHE_DB", "0") == "1"
+TRANSLATION_CACHE_DB_TTL = float(os.getenv("TRANSLATION_CACHE_DB_TTL", str(7 * 24 * 3600)))  # секунды
+TRANSLATION_CACHE_MAX_CHARS = int(os.getenv("TRANSLATION_CACHE_MAX_CHARS", "1000"))
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class TranslationCache:
+    """Кеш переводов с ключом (source, target, нормализованный текст)."""
+
+    def __init__(self, maxsize: int, ttl: float, use_db: bool):
+        self._memory = TTLCache(maxsize, ttl)
+        self._flight = SingleFlight()
+        self.use_db = use_db
+        self.db_hits = 0
+        self.db_misses = 0
+        self.upstream_calls = 0
+        self.saved_ms = 0.0
+        self.upstream_latency = LatencyHistogram()
+
+    @staticmethod
+    def make_key(text: str, source: str, target: str) -> str:
+        blob = f"{source}\x1f{target}\x1f{normalize_text(text)}"
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def _record_hit(self):
+        # Экономия — средняя задержка реального вызова, который не понадобился
+        hist = self.upstream_latency
+        if hist.count:
+            self.saved_ms += hist.total_ms / hist.count
+
+    async def _db_get(self, key: str):
+        try:
+            async with db_conn() as conn:
+                return await queries.fetchval(conn, "translation_get", key, TRANSLATION_CACHE_DB_TTL)
+        except (PoolExhaustedError, asyncpg.PostgresError) as e:
+            print(f"⚠️ Translation cache lookup failed: {e}")
+            return None
+
+    async def _db_put(self, key: str, source: str, target: str, translated: str):
+        try:
+            async with db_conn() as conn:
+                await queries.execute(conn, "translation_put", key, source, target, translated)
+        except (PoolExhaustedError, asyncpg.PostgresError) as e:
+            print(f"⚠️ Translation cache save failed: {e}")
+
+    async def prune(self):
+        """Удаляет из БД переводы старше TRANSLATION_CACHE_DB_TTL.
+
+        Работает и при выключенном use_db — чтобы подчистить строки,
+        оставшиеся с тех пор, когда уровень был включён.
+        """
+        try:
+            async with db_conn() as conn:
+                status = await queries.execute(conn, "translation_prune", TRANSLATION_CACHE_DB_TTL)
+        except (PoolExhaustedError, asyncpg.PostgresError) as e:
+            print(f"⚠️ Translation cache prune failed: {e}")
+            return
+        deleted = int(status.split()[-1]) if status else 0
+        if deleted:
+            print(f"🧹 Pruned {deleted} stale cached translations")
+
+    async def _load(self, key, text, source, target, user_id, premium) -> str:
+        if self.use_db:
+            translated = await self._db_get(key)
+            if translated is not None:
+                self.db_hits += 1
+                self._record_hit()
+                self._memory.set(key, translated)
+                return translated
+            self.db_misses += 1
+
+        started = time.perf_counter()
+        translated = await translate_miss(text, source, target, user_id=user_id, premium=premium)
+        self.upstream_latency.observe((time.perf_counter() - started) * 1000)
+        self.upstream_calls += 1
+
+        if translated:
+            self._memory.set(key, translated)
+            if self.use_db:
+                await self._db_put(key, source, target, translated)
+        return translated
+
+    async def translate(self, text: str, source: str, target: str,
+                        user_id: int = None, premium: bool = False) -> str:
+        if len(text) > TRANSLATION_CACHE_MAX_CHARS:
+            return await translate_upstream(text, source, target, user_id=user_id, premium=premium)
+
+        key = self.make_key(text, source, target)
+        cached = self._memory.get(key)
+        if cached is not TTLCache.MISSING:
+            self._record_hit()
+            return cached
+
+        # Одинаковые одновременные запросы — один поход в БД/Google
+        return await self._flight.do(
+            key, lambda: self._load(key, text, source, target, user_id, premium)
+        )
+
+    def stats(self) -> dict:
+        memory = self._memory.stats()
+        lookups = memory["hits"] + memory["misses"]
+        hits = memory["hits"] + self.db_hits
+        return {
+            "memory": memory,
+            "db_enabled": self.use_db,
+            "db_hits": self.db_hits,
+            "db_misses": self.db_misses,
+            "coalesced": self._flight.coalesced,
+            "upstream_calls": self.upstream_calls,
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            "saved_ms": round(self.saved_ms, 1),
+            "upstream_ms": self.upstream_latency.snapshot(),
+        }
+
+
+translation_cache = TranslationCache(TRANSLATION_CACHE_SIZE, TRANSLATION_CACHE_TTL, TRANSLATION_CACHE_DB)
+
+
+async def translate_text(text: str, source: str, target: str,
+                         user_id: int = None, premium: bool = False) -> str:
+    """Перевод через кеш; промахи идут в translate_miss."""
+    return await translation_cache.translate(text, source, target, user_id=user_id, premium=premium)
+
+
+# ========== Длинные тексты: перевод кусками ==========
+# deep-translator отклоняет тексты длиннее ~5000 символов
+TRANSLATION_CHUNK_CHARS = int(os.getenv("TRANSLATION_CHUNK_CHARS", "4500"))
+PARAGRAPH_SPLIT_RE = re.compile(r"\n\s*\n")
+LINE_SPLIT_RE = re.compile(r"\n")
+# Уровни разбиения: абзацы, затем строки; дальше — предложения (split_into_chunks)
+TRANSLATION_SPLIT_LEVELS = ((PARAGRAPH_SPLIT_RE, "\n\n"), (LINE_SPLIT_RE, "\n"))
+
+
+def _split_blocks(text: str, max_chars: int, level: int) -> list:
+    pattern, joiner = TRANSLATION_SPLIT_LEVELS[level]
+    parts = []
+    current = ""
+    for block in pattern.split(text.strip()):
+        if len(block) > max_chars:
+            if current:
+                parts.append((current, joiner))
+                current = ""
+            if level + 1 < len(TRANSLATION_SPLIT_LEVELS):
+                inner = _split_blocks(block, max_chars, level + 1)
+            else:
+                inner = [(piece, " ") for piece in split_into_chunks(block, max_chars)]
+            # Последний кусок блока склеивается со следующим разделителем этого уровня
+            inner[-1] = (inner[-1][0], joiner)
+            parts.extend(inner)
+        elif current and len(current) + len(joiner) + len(block) > max_chars:
+            parts.append((current, joiner))
+            current = block
+        else:
+            current = f"{current}{joiner}{block}" if current else block
+    if current:
+        parts.append((current, joiner))
+    return parts
+
+
+def split_for_translation(text: str, max_chars: int = TRANSLATION_CHUNK_CHARS) -> list:
+    """Делит текст по абзацам, длинные абзацы — по строкам, длинные строки — по предложениям.
+
+    Возвращает [(кусок, разделитель)], где разделитель — чем склеить
+    перевод куска со следующим, чтобы сохранить абзацы и переносы строк.
+    """
+    return _split_blocks(text, max_chars, 0)
+
+
+async def translate_long_text(text: str, source: str, target: str,
+                              user_id: int = None, premium: bool = False) -> str:
+    """Перевод любой длины: длинный текст переводится кусками параллельно."""
+    if len(text) <= TRANSLATION_CHUNK_CHARS:
+        return await translate_text(text, source, target, user_id=user_id, premium=premium)
+
+    parts = split_for_translation(text)
+    print(f"🧩 Long translation: {len(text)} chars in {len(parts)} chunks")
+    translated = await asyncio.gather(
+        *(translate_text(chunk, source, target, user_id=user_id, premium=premium) for chunk, _ in parts)
+    )
+    result = ""
+    for (_, joiner), piece in zip(parts, translated):
+        result += (piece or "") + joiner
+    return result.rstrip()
+
+
+# ========== Локальное определение языка ==========
+# langdetect работает в процессе за миллисекунды: если текст уже на целевом
+# языке, поход в Google Translate (и gTTS в голосовом режиме) не нужен.
+DetectorFactory.seed = 0  # детерминированный результат
+LANGDETECT_MIN_PROB = float(os.getenv("LANGDETECT_MIN_PROB", "0.9"))
+LANGDETECT_MIN_CHARS = int(os.getenv("LANGDETECT_MIN_CHARS", "12"))
+LANGDETECT_SAMPLE_CHARS = 1000
+
+LANGDETECT_METRICS = {"detections": 0, "confident": 0, "skipped": 0, "saved_ms": 0.0}
+LANGDETECT_LATENCY = LatencyHistogram()
+
+
+def detect_language(text: str):
+    """Язык текста (коды как в LANGUAGES: "en", "zh-CN"...) или None, если не уверены."""
+    sample = text[:LANGDETECT_SAMPLE_CHARS].strip()
+    if len(sample) < LANGDETECT_MIN_CHARS:
+        return None
+
+    started = time.perf_counter()
+    try:
+        candidates = detect_langs(sample)
+    except LangDetectException:
+        candidates = []
+    LANGDETECT_LATENCY.observe((time.perf_counter() - started) * 1000)
+    LANGDETECT_METRICS["detections"] += 1
+
+    if not candidates or candidates[0].prob < LANGDETECT_MIN_PROB:
+        return None
+    LANGDETECT_METRICS["confident"] += 1
+    lang = candidates[0].lang
+    # langdetect отдаёт zh-cn / zh-tw
+    return {"zh-cn": "zh-CN", "zh-tw": "zh-TW"}.get(lang, lang)
+
+
+def is_same_language(detected: str, target: str) -> bool:
+    if detected.startswith("zh") or target.startswith("zh"):
+        return detected.lower() == target.lower()
+    return detected.split("-")[0] == target.split("-")[0]
+
+
+async def translate_for_user(context: ContextTypes.DEFAULT_TYPE, text: str, src: str, tgt: str,
+                             state: dict):
+    """Перевод сообщения пользователя с локальной проверкой языка.
+
+    Возвращает (перевод, skipped). skipped=True — текст уже на целевом языке
+    и отдан как есть.
+    """
+    if src == "auto":
+        detected = detect_language(text)
+        if detected and is_same_language(detected, tgt):
+            LANGDETECT_METRICS["skipped"] += 1
+            hist = translation_executor.total
+            if hist.count:
+                LANGDETECT_METRICS["saved_ms"] += hist.total_ms / hist.count
+            return text, True
+
+    translated = await translate_long_text(
+        text,
+        "auto" if src == "auto" else convert_lang_code_for_translation(src),
+        convert_lang_code_for_translation(tgt),
+        user_id=state["user_id"],
+        premium=state["is_premium"],
+    )
+    return translated, False
+
+
+def get_langdetect_metrics() -> dict:
+    upstream = translation_executor.total
+    return {
+        **LANGDETECT_METRICS,
+        "saved_ms": round(LANGDETECT_METRICS["saved_ms"], 1),
+        "detect_ms": LANGDETECT_LATENCY.snapshot(),
+        "upstream_avg_ms": round(upstream.total_ms / upstream.count, 2) if upstream.count else None,
+    }
+
+
+async def recognize_speech(audio_data, language: str = None,
+                           user_id: int = None, premium: bool = False) -> str:
+    """recognize_google в потоке, через планировщик и circuit breaker recognition."""
+    kwargs = {"language": language} if language else {}
+    if GOOGLE_SPEECH_URL:
+        kwargs["endpoint"] = GOOGLE_SPEECH_URL
+
+    async def attempt():
+        async with schedulers["recognition"].slot(user_id, premium):
+            return await asyncio.to_thread(recognizer.recognize_google, audio_data, **kwargs)
+
+    return await call_with_resilience("recognition", attempt)
+
+
+# ========== Выходной формат голосовых (OGG/Opus) ==========
+# Голосовые Telegram — OGG/Opus: меньше байт на секунду речи и нормальная волна в клиенте
+VOICE_OUTPUT_OPUS = os.getenv("VOICE_OUTPUT_OPUS", "1") == "1"
+VOICE_OPUS_BITRATE = int(os.getenv("VOICE_OPUS_BITRATE", "32"))  # кбит/с
+ELEVENLABS_NATIVE_OPUS = os.getenv("ELEVENLABS_NATIVE_OPUS", "1") == "1"
+ELEVENLABS_OPUS_BITRATES = (32, 64, 96, 128, 192)
+ELEVENLABS_OPUS_FORMAT = "opus_48000_{}".format(
+    min(ELEVENLABS_OPUS_BITRATES, key=lambda b: abs(b - VOICE_OPUS_BITRATE))
+)
+AUDIO_WORKERS = int(os.getenv("AUDIO_WORKERS", "2"))
+audio_executor = ThreadPoolExecutor(max_workers=AUDIO_WORKERS, thread_name_prefix="audio")
+
+VOICE_OUTPUT_METRICS = {
+    "native": 0,
+    "transcoded": 0,
+    "failed": 0,
+    "input_bytes": 0,
+    "output_bytes": 0,
+}
+TRANSCODE_LATENCY = LatencyHistogram()
+
+
+def audio_format_of(audio: bytes) -> str:
+    return "ogg" if audio[:4] == b"OggS" else "mp3"
+
+
+def _transcode_to_opus(audio: bytes, source_format: str) -> bytes:
+    segment = AudioSegment.from_file(BytesIO(audio), format=source_format)
+    out = BytesIO()
+    segment.export(
+        out,
+        format="ogg",
+        codec="libopus",
+        bitrate=f"{VOICE_OPUS_BITRATE}k",
+        # bitexact: без случайного serial в OGG, чтобы одинаковый вход давал одинаковые байты
+        parameters=["-application", "voip", "-fflags", "+bitexact", "-flags:a", "+bitexact"],
+    )
+    return out.getvalue()
+
+
+async def to_voice_note(audio: bytes, source_format: str = "mp3") -> bytes:
+    """Приводит аудио к OGG/Opus для reply_voice.
+
+    Уже готовый OGG отдаётся как есть, остальное перекодируется в пуле
+    потоков. При ошибке ffmpeg возвращается исходный файл.
+    """
+    if not VOICE_OUTPUT_OPUS:
+        return audio
+    if audio_format_of(audio) == "ogg":
+        VOICE_OUTPUT_METRICS["native"] += 1
+        return audio
+
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(audio_executor, _transcode_to_opus, audio, source_format)
+    except Exception as e:
+        print(f"⚠️ Opus transcode failed, sending {source_format}: {e}")
+        VOICE_OUTPUT_METRICS["failed"] += 1
+        return audio
+
+    TRANSCODE_LATENCY.observe((time.perf_counter() - started) * 1000)
+    VOICE_OUTPUT_METRICS["transcoded"] += 1
+    VOICE_OUTPUT_METRICS["input_bytes"] += len(audio)
+    VOICE_OUTPUT_METRICS["output_bytes"] += len(result)
+    return result
 
-    if next_charge:
-        expires = datetime.fromisoformat(next_charge.replace("Z", "+00:00"))
-    else:
-        # если не пришло — деактивируем мгновенно
-        expires = datetime.utcnow()
 
-    db = await get_db()
+def get_voice_output_metrics() -> dict:
+    m = VOICE_OUTPUT_METRICS
+    return {
+        "opus_enabled": VOICE_OUTPUT_OPUS,
+        "bitrate_kbps": VOICE_OPUS_BITRATE,
+        "elevenlabs_format": ELEVENLABS_OPUS_FORMAT if ELEVENLABS_NATIVE_OPUS else None,
+        **m,
+        "size_ratio": round(m["output_bytes"] / m["input_bytes"], 4) if m["input_bytes"] else None,
+        "transcode_ms": TRANSCODE_LATENCY.snapshot(),
+    }
 
-    await db.execute("""
-        UPDATE premium_users
-        SET is_active = FALSE,
-            cancel_date = NOW(),
-            access_expires_at = $1
-        WHERE user_id = $2;
-    """, expires, user_id)
 
-    await db.close()
+# Задержки синтеза по режимам: время до первого байта и полное время
+SYNTH_LATENCY = {
+    mode: {"ttfb": LatencyHistogram(), "total": LatencyHistogram()}
+    for mode in ("stream", "buffered")
+}
 
-    # сообщение пользователю
-    msg = (
-        "❌ *Premium Subscription Cancelled*\n\n"
-        f"Your Premium access will remain active until:\n"
-        f"*{expires.strftime('%Y-%m-%d %H:%M')}*\n\n"
-        "After this date, your account will return to the free plan.\n\n"
-        "Thank you for being with us 💙"
-    )
 
-    await application.bot.send_message(
-        chat_id=user_id,
-        text=msg,
-        parse_mode="Markdown"
-    )
+async def elevenlabs_synthesize(voice_id: str, text: str, voice_settings: dict = None,
+                                timeout: float = ELEVENLABS_SYNTH_TIMEOUT,
+                                stream: bool = ELEVENLABS_STREAMING,
+                                output_format: str = None) -> bytes:
+    """Синтез речи клонированным голосом. Возвращает байты в output_format (по умолчанию MP3).
 
-    return {"status": "ok"}
+    Чанки ответа собираются сразу в память (без временных файлов).
+    Бросает ElevenLabsError на не-200 и httpx.TimeoutException по таймауту.
+    """
+    payload = {
+        "text": text,
+        "model_id": ELEVENLABS_MODEL_ID,
+        "voice_settings": voice_settings or dict(DEFAULT_VOICE_SETTINGS),
+    }
+    url = ELEVENLABS_TTS_STREAM_URL if stream else ELEVENLABS_TTS_URL
+    metrics = SYNTH_LATENCY["stream" if stream else "buffered"]
+
+    started = time.perf_counter()
+    buffer = BytesIO()
+    async with http_client.stream(
+        "POST",
+        url.format(voice_id=voice_id),
+        headers=elevenlabs_headers(),
+        params={"output_format": output_format} if output_format else None,
+        json=payload,
+        timeout=timeout,
+    ) as r:
+        if r.status_code != 200:
+            await r.aread()
+            raise ElevenLabsError(r.status_code, r.text)
+
+        async for chunk in r.aiter_bytes():
+            if buffer.tell() == 0:
+                metrics["ttfb"].observe((time.perf_counter() - started) * 1000)
+            buffer.write(chunk)
+
+    metrics["total"].observe((time.perf_counter() - started) * 1000)
+    return buffer.getvalue()
+
+
+# ========== Повторное использование file_id ==========
+FILE_ID_CACHE_SIZE = int(os.getenv("FILE_ID_CACHE_SIZE", "5000"))
+FILE_ID_CACHE_TTL = float(os.getenv("FILE_ID_CACHE_TTL", str(7 * 24 * 3600)))
+
+
+class TelegramFileIdStore:
+    """Запоминает file_id, который Telegram вернул для сгенерированного аудио.
+
+    Ключ — sha256 от байтов, поэтому одинаковый артефакт (повторный синтез,
+    одна и та же фраза gTTS) отправляется ссылкой, а не повторной загрузкой.
+    Память — первый уровень, Postgres — общий для всех воркеров; строки
+    старше FILE_ID_CACHE_TTL не читаются и удаляются сверкой.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize, ttl)
+        self.reused = 0
+        self.uploads = 0
+        self.stale = 0
+        self.bytes_saved = 0
+        self.upload_latency = {"ogg": LatencyHistogram(), "mp3": LatencyHistogram()}
+        self.upload_bytes = {"ogg": 0, "mp3": 0}
+
+    @staticmethod
+    def content_key(audio: bytes) -> str:
+        return hashlib.sha256(audio).hexdigest()
+
+    async def get(self, key: str):
+        file_id = self._cache.get(key)
+        if file_id is not TTLCache.MISSING:
+            return file_id
+        try:
+            async with db_conn() as conn:
+                file_id = await queries.fetchval(conn, "file_id_get", key, FILE_ID_CACHE_TTL)
+        except (PoolExhaustedError, asyncpg.PostgresError) as e:
+            print(f"⚠️ file_id lookup failed: {e}")
+            return None
+        if file_id:
+            self._cache.set(key, file_id)
+        return file_id
 
-async def deactivate_expired_premium():
-    db = await get_db()
+    async def put(self, key: str, file_id: str, size: int):
+        self._cache.set(key, file_id)
+        try:
+            async with db_conn() as conn:
+                await queries.execute(conn, "file_id_put", key, file_id, size)
+        except (PoolExhaustedError, asyncpg.PostgresError) as e:
+            print(f"⚠️ file_id save failed: {e}")
 
-    rows = await db.fetch("""
-        SELECT user_id FROM premium_users
-        WHERE is_active = FALSE
-        AND access_expires_at < NOW();
-    """)
+    async def forget(self, key: str):
+        self._cache.invalidate(key)
+        try:
+            async with db_conn() as conn:
+                await queries.execute(conn, "file_id_delete", key)
+        except (PoolExhaustedError, asyncpg.PostgresError) as e:
+            print(f"⚠️ file_id delete failed: {e}")
 
-    for row in rows:
-        uid = row["user_id"]
+    async def prune(self):
+        try:
+            async with db_conn() as conn:
+                status = await queries.execute(conn, "file_id_prune", FILE_ID_CACHE_TTL)
+        except (PoolExhaustedError, asyncpg.PostgresError) as e:
+            print(f"⚠️ file_id prune failed: {e}")
+            return
+        deleted = int(status.split()[-1]) if status else 0
+        if deleted:
+            print(f"🧹 Pruned {deleted} stale file_ids")
+
+    def stats(self) -> dict:
+        return {
+            "reused": self.reused,
+            "uploads": self.uploads,
+            "stale": self.stale,
+            "bytes_saved": self.bytes_saved,
+            "memory": self._cache.stats(),
+            "upload_bytes": dict(self.upload_bytes),
+            "upload_ms": {fmt: h.snapshot() for fmt, h in self.upload_latency.items()},
+        }
 
-        # удаляем premium
-        await db.execute("""
-            DELETE FROM premium_users WHERE user_id = $1;
-        """, uid)
 
-        # уведомляем
-        await application.bot.send_message(
-            chat_id=uid,
-            text="⏳ Premium has ended."
-        )
+file_id_store = TelegramFileIdStore(FILE_ID_CACHE_SIZE, FILE_ID_CACHE_TTL)
 
-    await db.close()
 
-async def premium_watcher_loop():
-    while True:
-        try:
-            await deactivate_expired_premium()
-        except Exception as e:
-            print("❌ Premium watcher error:", e)
+async def send_voice_artifact(message, audio: bytes, reusable: bool = False, **kwargs):
+    """reply_voice по file_id, если этот артефакт уже загружался; иначе загрузка байтов.
 
-        await asyncio.sleep(3600)  # проверка каждый час
+    reusable=True — только для байтов, которые могут повториться (synth_cache, gTTS).
+    Остальное (перевод голоса клоном) почти всегда уникально: в БД за file_id не ходим.
+    """
+    key = TelegramFileIdStore.content_key(audio) if reusable else None
 
+    file_id = await file_id_store.get(key) if reusable else None
+    if file_id:
+        try:
+            sent = await message.reply_voice(voice=file_id, **kwargs)
+            file_id_store.reused += 1
+            file_id_store.bytes_saved += len(audio)
+            return sent
+        except BadRequest as e:
+            # file_id протух или принадлежит другому боту — грузим заново
+            print(f"⚠️ Stale file_id for {key[:12]}: {e}")
+            file_id_store.stale += 1
+            await file_id_store.forget(key)
+
+    started = time.perf_counter()
+    sent = await message.reply_voice(voice=audio, **kwargs)
+    fmt = audio_format_of(audio)
+    file_id_store.upload_latency[fmt].observe((time.perf_counter() - started) * 1000)
+    file_id_store.upload_bytes[fmt] += len(audio)
+    file_id_store.uploads += 1
+
+    if reusable and sent is not None and sent.voice is not None:
+        await file_id_store.put(key, sent.voice.file_id, len(audio))
+    return sent
+
+
+# ========== Длинные ответы ==========
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    """Режет текст на части <= limit, по возможности по строкам, затем по словам."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+async def send_long_text(message, text: str, parse_mode: str = None, reply_markup=None, edit: bool = False):
+    """Отправляет текст частями до 4096 символов; кнопки — у последней части.
+
+    edit=True — первая часть заменяет сам message (processing-сообщение бота).
+    """
+    parts = split_message(text)
+    for i, part in enumerate(parts):
+        markup = reply_markup if i == len(parts) - 1 else None
+        send = message.edit_text if edit and i == 0 else message.reply_text
+        try:
+            await send(part, parse_mode=parse_mode, reply_markup=markup)
+        except BadRequest:
+            # Разрез мог попасть внутрь Markdown-разметки — шлём как есть
+            await send(part, reply_markup=markup)
+
+
+# ========== Дисковый кеш синтеза ==========
+SYNTH_CACHE_DIR = os.getenv("SYNTH_CACHE_DIR", os.path.join(tempfile.gettempdir(), "synth_cache"))
+SYNTH_CACHE_MAX_BYTES = int(float(os.getenv("SYNTH_CACHE_MAX_MB", "200")) * 1024 * 1024)
+
+
+class SynthesisCache:
+    """Ограниченный по размеру дисковый LRU-кеш синтезированного аудио.
+
+    Ключ — sha256 от нормализованного текста, voice_id, model_id и
+    voice_settings. Имя файла начинается с voice_id, чтобы удаление
+    голоса сносило все его записи. Порядок LRU переживает рестарт
+    через mtime файлов.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index = OrderedDict()  # имя файла -> размер
+        self._total = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(voice_id: str, text: str, model_id: str, voice_settings: dict,
+                 output_format: str) -> str:
+        normalized = normalize_text(text)
+        blob = json.dumps(
+            {
+                "text": normalized,
+                "voice_id": voice_id,
+                "model_id": model_id,
+                "voice_settings": voice_settings,
+                "output_format": output_format,
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        digest = hashlib.sha256(blob.encode("utf-8")).hexdigest()
+        return f"{SynthesisCache._voice_prefix(voice_id)}{digest}"
 
-def start_premium_watcher():
-    loop = asyncio.get_event_loop()
-    loop.create_task(premium_watcher_loop())
+    @staticmethod
+    def _voice_prefix(voice_id: str) -> str:
+        return re.sub(r"[^A-Za-z0-9_-]", "_", voice_id) + "__"
 
-# 🔁 Job для JobQueue: просто вызывает deactivate_expired_premium
-async def check_expired_premium_job(context: ContextTypes.DEFAULT_TYPE):
-    await deactivate_expired_premium()
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
 
-async def init_db():
-    """Создаёт подключение к БД и таблицы, если их нет."""
-    global db_pool
-    db_pool = await asyncpg.create_pool(DATABASE_URL)
+    # Методы ниже работают в потоках asyncio.to_thread, поэтому _index/_total/_loaded
+    # меняются только под self._lock; чтение и запись файлов — вне блокировки.
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._loaded:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            entries = [e for e in os.scandir(self.directory) if e.is_file() and not e.name.endswith(".tmp")]
+            entries.sort(key=lambda e: e.stat().st_mtime)
+            for entry in entries:
+                size = entry.stat().st_size
+                self._index[entry.name] = size
+                self._total += size
+            self._loaded = True
+            doomed = self._evict_locked()
+        self._unlink(doomed)
+
+    def _evict_locked(self) -> list:
+        """Вытесняет старые записи из индекса; возвращает имена файлов на удаление."""
+        doomed = []
+        while self._total > self.max_bytes and self._index:
+            name, size = self._index.popitem(last=False)
+            self._total -= size
+            self.evictions += 1
+            doomed.append(name)
+        return doomed
+
+    def _unlink(self, names):
+        for name in names:
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
 
-    async with db_pool.acquire() as conn:
+    def _read(self, key: str):
+        self._ensure_loaded()
+        with self._lock:
+            if key not in self._index:
+                return None
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            # Файл вытеснили параллельно
+            with self._lock:
+                self._total -= self._index.pop(key, 0)
+            return None
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+        return data
+
+    def _write(self, key: str, data: bytes):
+        self._ensure_loaded()
+        # У каждого потока свой .tmp, чтобы одновременные записи одного ключа не мешали друг другу
+        tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            self._total += len(data) - self._index.pop(key, 0)
+            self._index[key] = len(data)
+            doomed = self._evict_locked()
+        self._unlink(doomed)
+
+    def _remove_voice(self, voice_id: str) -> int:
+        self._ensure_loaded()
+        prefix = self._voice_prefix(voice_id)
+        with self._lock:
+            removed = [name for name in self._index if name.startswith(prefix)]
+            for name in removed:
+                self._total -= self._index.pop(name)
+        self._unlink(removed)
+        return len(removed)
+
+    async def get(self, key: str):
+        data = await asyncio.to_thread(self._read, key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
 
-        # Таблица премиум-пользователей
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS premium_users (
-                user_id BIGINT PRIMARY KEY,
-                is_active BOOLEAN DEFAULT TRUE,
-                purchase_date TIMESTAMP,
-                cancel_date TIMESTAMP,
-                access_expires_at TIMESTAMP
-            );
+    async def put(self, key: str, data: bytes):
+        try:
+            await asyncio.to_thread(self._write, key, data)
+        except OSError as e:
+            print(f"⚠️ Synthesis cache write failed: {e}")
+
+    async def invalidate_voice(self, voice_id: str):
+        removed = await asyncio.to_thread(self._remove_voice, voice_id)
+        self.invalidations += removed
+        if removed:
+            print(f"🗑 Dropped {removed} cached syntheses for voice {voice_id}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        with self._lock:
+            entries, total = len(self._index), self._total
+        return {
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "coalesced": synth_flight.coalesced,
+        }
 
-        """)
 
-        # Таблица клонированных голосов
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS cloned_voices (
-                user_id BIGINT PRIMARY KEY,
-                voice_id TEXT NOT NULL,
-                source_lang TEXT,
-                target_lang TEXT,
-                created_at TIMESTAMP DEFAULT NOW()
-            );
-        """)
+synth_cache = SynthesisCache(SYNTH_CACHE_DIR, SYNTH_CACHE_MAX_BYTES)
+synth_flight = SingleFlight()
+
+
+async def synthesize_speech(voice_id: str, text: str, voice_settings: dict = None,
+                            user_id: int = None, premium: bool = False) -> bytes:
+    """Синтез через дисковый кеш; одинаковые параллельные запросы — один вызов ElevenLabs."""
+    voice_settings = voice_settings or dict(DEFAULT_VOICE_SETTINGS)
+    native_format = ELEVENLABS_OPUS_FORMAT if VOICE_OUTPUT_OPUS and ELEVENLABS_NATIVE_OPUS else None
+    output_format = "ogg_opus_{}".format(VOICE_OPUS_BITRATE) if VOICE_OUTPUT_OPUS else "mp3"
+    key = SynthesisCache.make_key(voice_id, text, ELEVENLABS_MODEL_ID, voice_settings, output_format)
+
+    cached = await synth_cache.get(key)
+    if cached is not None:
+        return cached
+
+    async def attempt():
+        async with schedulers["elevenlabs"].slot(user_id, premium):
+            return await elevenlabs_synthesize(voice_id, text, voice_settings, output_format=native_format)
+
+    async def produce():
+        audio = await call_with_resilience("elevenlabs", attempt)
+        # Кешируем уже готовое голосовое, чтобы не перекодировать при попадании
+        audio = await to_voice_note(audio)
+        await synth_cache.put(key, audio)
+        return audio
+
+    return await synth_flight.do(key, produce)
+
+
+# ========== Длинные тексты: синтез по предложениям ==========
+# Длинный текст одним запросом упирается в таймаут; режем по предложениям
+# и синтезируем куски параллельно, затем склеиваем в одно голосовое.
+LONG_TEXT_THRESHOLD = int(os.getenv("LONG_TEXT_THRESHOLD", "600"))  # символов
+SYNTH_CHUNK_CHARS = int(os.getenv("SYNTH_CHUNK_CHARS", "400"))
+SYNTH_PER_USER_CONCURRENCY = int(os.getenv("SYNTH_PER_USER_CONCURRENCY", "3"))
+
+SENTENCE_END_RE = re.compile(r"(?<=[.!?…。！？])\s+")
+CLAUSE_END_RE = re.compile(r"(?<=[,;:，；])\s+")
+
+_user_synth_semaphores = weakref.WeakValueDictionary()
+LONG_SYNTH_METRICS = {"requests": 0, "chunks": 0, "chars": 0}
+LONG_SYNTH_LATENCY = LatencyHistogram()
+
+
+def _split_oversized(piece: str, max_chars: int) -> list:
+    """Режет слишком длинное предложение по запятым, затем по пробелам."""
+    parts = []
+    for clause in CLAUSE_END_RE.split(piece):
+        while len(clause) > max_chars:
+            cut = clause.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            parts.append(clause[:cut].strip())
+            clause = clause[cut:].strip()
+        if clause:
+            parts.append(clause)
+    return parts
+
+
+def split_into_chunks(text: str, max_chars: int = SYNTH_CHUNK_CHARS) -> list:
+    """Делит текст на куски <= max_chars по границам предложений (порядок сохраняется)."""
+    chunks = []
+    current = ""
+    for sentence in SENTENCE_END_RE.split(text.strip()):
+        pieces = [sentence] if len(sentence) <= max_chars else _split_oversized(sentence, max_chars)
+        for piece in pieces:
+            if current and len(current) + 1 + len(piece) > max_chars:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _concat_audio(parts: list) -> bytes:
+    combined = AudioSegment.empty()
+    for part in parts:
+        combined += AudioSegment.from_file(BytesIO(part), format=audio_format_of(part))
+    out = BytesIO()
+    if VOICE_OUTPUT_OPUS:
+        combined.export(out, format="ogg", codec="libopus", bitrate=f"{VOICE_OPUS_BITRATE}k",
+                        parameters=["-application", "voip"])
+    else:
+        combined.export(out, format="mp3")
+    return out.getvalue()
 
-    print("🗄 PostgreSQL initialized. premium_users & cloned_voices tables ready.")
 
-async def save_cloned_voice(user_id: int, voice_id: str, src: str, tgt: str):
-    async with db_pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO cloned_voices (user_id, voice_id, source_lang, target_lang)
-            VALUES ($1, $2, $3, $4)
-            ON CONFLICT (user_id) DO UPDATE SET
-                voice_id = EXCLUDED.voice_id,
-                source_lang = EXCLUDED.source_lang,
-                target_lang = EXCLUDED.target_lang,
-                created_at = NOW();
-        """, user_id, voice_id, src, tgt)
+async def synthesize_long_text(voice_id: str, text: str, voice_settings: dict = None,
+                               user_id: int = None, premium: bool = False) -> bytes:
+    """Синтез произвольной длины: короткий текст — одним запросом, длинный — кусками.
 
-async def get_cloned_voice(user_id: int):
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            SELECT voice_id, source_lang, target_lang
-            FROM cloned_voices
-            WHERE user_id = $1;
-        """, user_id)
-        return row
+    Куски идут через synthesize_speech (кеш, планировщик, circuit breaker),
+    не более SYNTH_PER_USER_CONCURRENCY одновременно на пользователя.
+    """
+    if len(text) <= LONG_TEXT_THRESHOLD:
+        return await synthesize_speech(voice_id, text, voice_settings, user_id=user_id, premium=premium)
 
-async def delete_cloned_voice(user_id: int):
-    """Удаляет клонированный голос (используется если нужно сбросить)."""
-    async with db_pool.acquire() as conn:
-        await conn.execute("""
-            DELETE FROM cloned_voices WHERE user_id = $1;
-        """, user_id)
+    chunks = split_into_chunks(text)
+    started = time.perf_counter()
 
-async def add_premium(user_id: int):
-    """Добавляет пользователя в таблицу Premium."""
-    async with db_pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO premium_users (user_id)
-            VALUES ($1)
-            ON CONFLICT DO NOTHING;
-        """, user_id)
+    semaphore = _user_synth_semaphores.get(user_id)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(SYNTH_PER_USER_CONCURRENCY)
+        _user_synth_semaphores[user_id] = semaphore
 
-async def remove_premium(user_id: int):
-    """Удаляет пользователя из таблицы Premium."""
-    async with db_pool.acquire() as conn:
-        await conn.execute("""
-            DELETE FROM premium_users
-            WHERE user_id = $1;
-        """, user_id)
+    async def synth_chunk(chunk: str) -> bytes:
+        async with semaphore:
+            return await synthesize_speech(voice_id, chunk, voice_settings, user_id=user_id, premium=premium)
 
+    parts = await asyncio.gather(*(synth_chunk(chunk) for chunk in chunks))
+    audio = await asyncio.get_running_loop().run_in_executor(audio_executor, _concat_audio, parts)
 
-async def is_premium(user_id: int) -> bool:
-    """Проверяет, есть ли пользователь в Premium."""
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            SELECT user_id FROM premium_users WHERE user_id = $1;
-        """, user_id)
-        return row is not None
+    LONG_SYNTH_LATENCY.observe((time.perf_counter() - started) * 1000)
+    LONG_SYNTH_METRICS["requests"] += 1
+    LONG_SYNTH_METRICS["chunks"] += len(chunks)
+    LONG_SYNTH_METRICS["chars"] += len(text)
+    print(f"🧩 Long text: {len(text)} chars in {len(chunks)} chunks")
+    return audio
 
-print(os.environ)  # или хотя бы os.environ.keys()
-# Load env vars
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-ELEVENLABS_API_KEY = os.getenv("ELEVEN_API_KEY")
-ELEVENLABS_VOICE_CLONE_URL = "https://api.elevenlabs.io/v1/voices/add"
-# читаем product ID из переменной окружения
-GUMROAD_PRODUCT_ID = os.getenv("GUMROAD_PRODUCT_ID")
-# PREMIUM_USERS = {}   временное хранилище Premium (можно заменить на БД)
 
-DEFAULT_TARGET = os.getenv("TARGET_LANG", "en")
-application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-start_premium_watcher()
+def get_synth_metrics():
+    return {
+        **{
+            mode: {name: hist.snapshot() for name, hist in hists.items()}
+            for mode, hists in SYNTH_LATENCY.items()
+        },
+        "long_text": {**LONG_SYNTH_METRICS, "total_ms": LONG_SYNTH_LATENCY.snapshot()},
+    }
 
 
 recognizer = sr.Recognizer()
 # Реферальная система и лимиты
 FREE_VOICE_LIMIT = 1  # Лимит для обычных пользователей
+FREE_TEXT_TO_VOICE_LIMIT = 1
 PREMIUM_REFERRAL_CODES = {
     "just_me": "Sam",
     "blogger_alex": "Alex Tech",
@@ -405,18 +2902,25 @@ async def telegram_webhook(request: Request):
 
 
 
-#1 Функция для проверки лимитов
-def check_voice_cloning_limit(context, user_id):
-    """Проверяет может ли пользователь клонировать голос"""
-    is_premium = context.user_data.get("is_premium", False)
-    if is_premium:
-        return True, None
-    
-    cloning_count = context.user_data.get("voice_cloning_count", 0)
-    if cloning_count >= 1:
-        return False, f"""⚠️ **Voice cloning limit reached!**
+#1 Лимиты бесплатного тарифа — хранятся в usage_quotas (PostgreSQL)
+QUOTA_VOICE_CLONING = "voice_cloning"
+QUOTA_TEXT_TO_VOICE = "text_to_voice"
+
+FREE_QUOTA_LIMITS = {
+    QUOTA_VOICE_CLONING: FREE_VOICE_LIMIT,
+    QUOTA_TEXT_TO_VOICE: FREE_TEXT_TO_VOICE_LIMIT,
+}
+
+# Зеркало счётчиков в user_data — для текста статуса
+QUOTA_COUNT_KEYS = {
+    QUOTA_VOICE_CLONING: "voice_cloning_count",
+    QUOTA_TEXT_TO_VOICE: "text_to_voice_count",
+}
+
+QUOTA_LIMIT_MESSAGES = {
+    QUOTA_VOICE_CLONING: f"""⚠️ **Voice cloning limit reached!**
 
-🎭 You've used your 1 free voice cloning attempt.
+🎭 You've used your {FREE_VOICE_LIMIT} free voice cloning attempt.
 💫 **Get unlimited access:**
 • Contact us for premium access
 • Or ask your favorite tech blogger for a special link!
@@ -424,21 +2928,11 @@ def check_voice_cloning_limit(context, user_id):
 📱 **Free features still available:**
 • Text translation
 • Voice recognition
-• Basic voice-to-voice"""
-    
-    return True, None
+• Basic voice-to-voice""",
 
-def check_text_to_voice_limit(context, user_id):
-    """Проверяет может ли пользователь использовать Text → Voice"""
-    is_premium = context.user_data.get("is_premium", False)
-    if is_premium:
-        return True, None
-    
-    text_to_voice_count = context.user_data.get("text_to_voice_count", 0)
-    if text_to_voice_count >= 1:
-        return False, f"""⚠️ **Text → Voice limit reached!**
+    QUOTA_TEXT_TO_VOICE: f"""⚠️ **Text → Voice limit reached!**
 
-🎤 You've used your 1 free text-to-voice attempt.
+🎤 You've used your {FREE_TEXT_TO_VOICE_LIMIT} free text-to-voice attempt.
 
 💫 **Get unlimited access:**
 • Contact us for premium access
@@ -447,21 +2941,34 @@ def check_text_to_voice_limit(context, user_id):
 📱 **Free features still available:**
 • Text translation
 • Voice recognition  
-• Basic voice-to-voice"""
-    
+• Basic voice-to-voice""",
+}
+
+async def try_consume_quota(context, user_id, feature):
+    """Проверяет и списывает бесплатную попытку одним атомарным запросом.
+
+    Возвращает (True, None) или (False, текст о лимите).
+    """
+    if context.user_data.get("is_premium", False):
+        return True, None
+
+    limit = FREE_QUOTA_LIMITS[feature]
+    used = await consume_quota(user_id, feature, limit)
+    if used is None:
+        context.user_data[QUOTA_COUNT_KEYS[feature]] = limit
+        return False, QUOTA_LIMIT_MESSAGES[feature]
+
+    context.user_data[QUOTA_COUNT_KEYS[feature]] = used
     return True, None
 
-def increment_voice_cloning_count(context):
-    """Увеличивает счетчик клонирования голоса"""
-    if not context.user_data.get("is_premium", False):
-        current = context.user_data.get("voice_cloning_count", 0)
-        context.user_data["voice_cloning_count"] = current + 1
+async def release_quota(context, user_id, feature):
+    """Возвращает попытку, если платный вызов не удался."""
+    if context.user_data.get("is_premium", False):
+        return
 
-def increment_text_to_voice_count(context):
-    """Увеличивает счетчик Text → Voice"""
-    if not context.user_data.get("is_premium", False):
-        current = context.user_data.get("text_to_voice_count", 0)
-        context.user_data["text_to_voice_count"] = current + 1
+    used = await refund_quota(user_id, feature)
+    if used is not None:
+        context.user_data[QUOTA_COUNT_KEYS[feature]] = used
 
 def get_remaining_attempts_detailed(context):
     """Возвращает детальную информацию об оставшихся попытках"""
@@ -471,16 +2978,10 @@ def get_remaining_attempts_detailed(context):
     cloning_used = context.user_data.get("voice_cloning_count", 0)
     text_to_voice_used = context.user_data.get("text_to_voice_count", 0)
     
-    cloning_remaining = max(0, 1 - cloning_used)
-    text_to_voice_remaining = max(0, 1 - text_to_voice_used)
+    cloning_remaining = max(0, FREE_VOICE_LIMIT - cloning_used)
+    text_to_voice_remaining = max(0, FREE_TEXT_TO_VOICE_LIMIT - text_to_voice_used)
     
-    return f"Cloning: {cloning_remaining}/1, Text→Voice: {text_to_voice_remaining}/1"
-
-def increment_voice_count(context):
-    """Увеличивает счетчик использования клонирования"""
-    if not context.user_data.get("is_premium", False):
-        current = context.user_data.get("voice_cloning_count", 0)
-        context.user_data["voice_cloning_count"] = current + 1
+    return f"Cloning: {cloning_remaining}/{FREE_VOICE_LIMIT}, Text→Voice: {text_to_voice_remaining}/{FREE_TEXT_TO_VOICE_LIMIT}"
 
 def get_remaining_attempts(context):
     """Возвращает количество оставшихся попыток"""
@@ -614,6 +3115,8 @@ Ready to start?""",
         "could_not_understand": "❌ **Could not understand audio**\n\nTry:\n• Speaking more clearly\n• Checking source language\n• Recording in quieter environment\n• **Shorter messages (under 60s)**",
         "recognition_error": "❌ Recognition error: {error}",
         "translation_error": "❌ Translation error: {error}",
+        "already_target_lang": "ℹ️ **Already in {tgt_lang}** — nothing to translate or voice.",
+        "service_busy": "⏳ **Service is temporarily busy**\n\nThe upstream service is not responding. Please try again in a minute.",
         "source_lang_required": "⚠️ **Source language required for cloning**\n\nPlease set a specific source language in ⚙️ Settings first.",
         "need_longer_audio": "⚠️ **Need longer audio for cloning**\n\nFirst clone needs 30+ seconds.\nYour audio: {duration:.1f} seconds\n\nAfter first clone, any length works!",
         "voice_synthesis_failed": "❌ **Voice synthesis failed**\n\n{error}",
@@ -857,6 +3360,8 @@ Choose language for your cloned voice:"""
         "could_not_understand": "❌ **Не удалось понять аудио**\n\nПопробуйте:\n• Говорить четче\n• Проверить исходный язык\n• Записать в тихой обстановке\n• **Короткие сообщения (до 60с)**",
         "recognition_error": "❌ Ошибка распознавания: {error}",
         "translation_error": "❌ Ошибка перевода: {error}",
+        "already_target_lang": "ℹ️ **Уже на языке {tgt_lang}** — переводить и озвучивать нечего.",
+        "service_busy": "⏳ **Сервис временно перегружен**\n\nВнешний сервис не отвечает. Попробуйте через минуту.",
         "source_lang_required": "⚠️ **Нужен исходный язык для клонирования**\n\nПожалуйста, сначала установите конкретный исходный язык в ⚙️ Настройках.",
         "need_longer_audio": "⚠️ **Нужно более длинное аудио для клонирования**\n\nДля первого клона нужно 30+ секунд.\nВаше аудио: {duration:.1f} секунд\n\nПосле первого клона работает любая длина!",
         "voice_synthesis_failed": "❌ **Не удалось синтезировать голос**\n\n{error}",
@@ -1382,9 +3887,9 @@ def convert_lang_code_for_translation(lang_code):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_id = update.effective_user.id
-    db_voice = await get_cloned_voice(user_id)
-    if db_voice:
-        context.user_data["cloned_voice_id"] = db_voice["voice_id"]
+    state = await load_user_state(context, user_id)
+    if state["voice_id"]:
+        context.user_data["cloned_voice_id"] = state["voice_id"]
     
     # Определяем регион пользователя по IP
     region_data = determine_user_region()
@@ -1403,7 +3908,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["currency_symbol"] = region_data['symbol']
 
     # Восстанавливаем премиум, если вебхук уже сработал
-    if await is_premium(user_id):
+    if state["is_premium"]:
         context.user_data["is_premium"] = True
     
     # Определяем язык интерфейса пользователя
@@ -1475,13 +3980,12 @@ async def back_to_menu_handler(update, context):
         )
 
 async def sync_user_state(context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    # premium из БД
-    context.user_data["is_premium"] = await is_premium(user_id)
+    # premium и cloned voice из БД (один запрос на апдейт)
+    state = await load_user_state(context, user_id)
+    context.user_data["is_premium"] = state["is_premium"]
 
-    # cloned voice из БД
-    row = await get_cloned_voice(user_id)
-    if row:
-        context.user_data["cloned_voice_id"] = row["voice_id"]
+    if state["voice_id"]:
+        context.user_data["cloned_voice_id"] = state["voice_id"]
 
         # context.user_data["source_lang"] = row["source_lang"]
         # context.user_data["target_lang"] = row["target_lang"]
@@ -1853,47 +4357,32 @@ async def handle_lang_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
         # Синтезируем голос
         voice_id = context.user_data.get("cloned_voice_id")
-        
-        synth_url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
-        headers = {"xi-api-key": ELEVENLABS_API_KEY, "Content-Type": "application/json"}
-        
-        payload = {
-            "text": user_text,
-            "model_id": "eleven_multilingual_v2", 
-            "voice_settings": {
-                "stability": 0.5,
-                "similarity_boost": 0.75
-            }
-        }
+        state = await load_user_state(context, query.from_user.id)
         
         try:
-            r = requests.post(synth_url, headers=headers, json=payload)
+            audio_bytes = await synthesize_long_text(
+                voice_id, user_text, user_id=state["user_id"], premium=state["is_premium"]
+            )
+
+            # Удаляем processing message
+            await processing_msg.delete()
+
+            # Отправляем результат прямо из памяти
+            lang_display = get_lang_display_name(target_lang)
+            caption = f"🎤 Your voice: {lang_display}\n\n📝 Text: {user_text[:100]}..."
             
-            if r.status_code == 200:
-                tmp_out = tempfile.NamedTemporaryFile(suffix=".mp3", delete=False)
-                tmp_out.write(r.content)
-                tmp_out.flush()
-                tmp_out_path = tmp_out.name
-                tmp_out.close()
-
-                # Удаляем processing message
-                await processing_msg.delete()
-
-                # Отправляем результат
-                lang_display = get_lang_display_name(target_lang)
-                caption = f"🎤 Your voice: {lang_display}\n\n📝 Text: {user_text[:100]}..."
-                
-                with open(tmp_out_path, "rb") as af:
-                    await query.message.reply_voice(voice=af, caption=caption)
-                
-                os.remove(tmp_out_path)
-                
-                # Очищаем сохраненный текст
-                context.user_data["text_to_synthesize"] = None
-                
-            else:
-                await processing_msg.edit_text(f"❌ Error: {r.status_code}")
+            await send_voice_artifact(
+                query.message, audio_bytes, caption=caption,
+                reusable=len(user_text) <= LONG_TEXT_THRESHOLD,
+            )
+            
+            # Очищаем сохраненный текст
+            context.user_data["text_to_synthesize"] = None
                 
+        except CircuitOpenError:
+            await processing_msg.edit_text(get_text(context, "service_busy"), parse_mode="Markdown")
+        except ElevenLabsError as e:
+            await processing_msg.edit_text(f"❌ Error: {e.status_code}")
         except Exception as e:
             await processing_msg.edit_text(f"❌ Error: {str(e)}")
         
@@ -1908,9 +4397,9 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # 🔄 ВАЖНО: восстановление voice_id из БД
         if not context.user_data.get("cloned_voice_id"):
-            db_voice = await get_cloned_voice(update.effective_user.id)
-            if db_voice:
-                context.user_data["cloned_voice_id"] = db_voice["voice_id"]
+            state = await load_user_state(context, update.effective_user.id)
+            if state["voice_id"]:
+                context.user_data["cloned_voice_id"] = state["voice_id"]
 
         # ❌ Если всё ещё нет — реально нет
         if not context.user_data.get("cloned_voice_id"):
@@ -1922,13 +4411,9 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 ])
             )
             return
-        # Используем функцию проверки Text → Voice
+        # Проверяем и списываем попытку Text → Voice (премиум — без лимитов)
         user_id = update.effective_user.id
-        # Премиум = пропускаем лимиты НАВСЕГДА
-        if context.user_data.get("is_premium", False):
-            can_use = True
-        else:
-            can_use, limit_msg = check_voice_cloning_limit(context, user_id)
+        can_use, limit_msg = await try_consume_quota(context, user_id, QUOTA_TEXT_TO_VOICE)
         
         if not can_use:
             await update.message.reply_text(
@@ -1938,8 +4423,6 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        # Увеличиваем счетчик Text → Voice
-        increment_text_to_voice_count(context)
         user_text = update.message.text
         voice_id = context.user_data.get("cloned_voice_id")
        
@@ -1948,66 +4431,61 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             get_text(context, "generating_cloned"),
             parse_mode="Markdown"
         )
+        voice_sent = False
         
         try:
             # Синтезируем голос через ElevenLabs (язык определится автоматически)
-            synth_url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
-            headers = {"xi-api-key": ELEVENLABS_API_KEY, "Content-Type": "application/json"}
-            
-            payload = {
-                "text": user_text,
-                "model_id": "eleven_multilingual_v2", 
-                "voice_settings": {
-                    "stability": 0.5,
-                    "similarity_boost": 0.75
-                }
-            }
-            
             print(f"🎤 Auto-synthesizing text with voice {voice_id}")
             print(f"📝 Text: {user_text[:100]}...")
             
-            r = requests.post(synth_url, headers=headers, json=payload, timeout=30)
+            state = await load_user_state(context, user_id)
+            audio_bytes = await synthesize_long_text(
+                voice_id, user_text, user_id=user_id, premium=state["is_premium"]
+            )
+
+            # Удаляем processing message
+            await processing_msg.delete()
+
+            # Отправляем результат прямо из памяти
+            short_text = user_text[:150] + "..." if len(user_text) > 150 else user_text
+            caption = f"🎤 **Your cloned voice**\n\n📝 **Text:** {short_text}"
             
-            if r.status_code == 200:
-                # Сохраняем аудио
-                with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp_out:
-                    tmp_out.write(r.content)
-                    tmp_out.flush()
-                    tmp_out_path = tmp_out.name
-
-                # Удаляем processing message
-                await processing_msg.delete()
-
-                # Отправляем результат
-                short_text = user_text[:150] + "..." if len(user_text) > 150 else user_text
-                caption = f"🎤 **Your cloned voice**\n\n📝 **Text:** {short_text}"
-                
-                with open(tmp_out_path, "rb") as af:
-                    await update.message.reply_voice(
-                        voice=af, 
-                        caption=caption,
-                        parse_mode="Markdown",
-                        reply_markup=None
-                    )
-                
-                # Если текст очень длинный, отправляем его отдельно
-                if len(user_text) > 300:
-                    await update.message.reply_text(
-                        f"📝 **Full text:**\n\n{user_text}",
-                        parse_mode="Markdown"
-                    )
-                
-                os.remove(tmp_out_path)
-                
-            else:
-                print(f"❌ ElevenLabs synthesis error: {r.status_code} - {r.text}")
-                await processing_msg.edit_text(
-                    f"❌ **Voice synthesis failed**\n\nError: {r.status_code}\n\nTry again or contact support.",
-                    parse_mode="Markdown",
-                    reply_markup=get_back_button(context)
+            await send_voice_artifact(
+                update.message,
+                audio_bytes,
+                caption=caption,
+                parse_mode="Markdown",
+                reply_markup=None,
+                # Короткий текст — ровно байты из synth_cache; склейка длинного уникальна
+                reusable=len(user_text) <= LONG_TEXT_THRESHOLD,
+            )
+            voice_sent = True
+            
+            # Если текст очень длинный, отправляем его отдельно
+            if len(user_text) > 300:
+                await send_long_text(
+                    update.message,
+                    f"📝 **Full text:**\n\n{user_text}",
+                    parse_mode="Markdown"
                 )
                 
-        except requests.exceptions.Timeout:
+        except ElevenLabsError as e:
+            print(f"❌ ElevenLabs synthesis error: {e.status_code} - {e.text}")
+            await release_quota(context, user_id, QUOTA_TEXT_TO_VOICE)
+            await processing_msg.edit_text(
+                f"❌ **Voice synthesis failed**\n\nError: {e.status_code}\n\nTry again or contact support.",
+                parse_mode="Markdown",
+                reply_markup=get_back_button(context)
+            )
+        except CircuitOpenError:
+            await release_quota(context, user_id, QUOTA_TEXT_TO_VOICE)
+            await processing_msg.edit_text(
+                get_text(context, "service_busy"),
+                parse_mode="Markdown",
+                reply_markup=get_back_button(context)
+            )
+        except httpx.TimeoutException:
+            await release_quota(context, user_id, QUOTA_TEXT_TO_VOICE)
             await processing_msg.edit_text(
                 "⏱️ **Timeout error**\n\nSynthesis took too long. Try with shorter text.",
                 parse_mode="Markdown",
@@ -2015,6 +4493,9 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         except Exception as e:
             print(f"Exception in TTS synthesis: {e}")
+            # Голос не дошёл до пользователя — попытку не списываем
+            if not voice_sent:
+                await release_quota(context, user_id, QUOTA_TEXT_TO_VOICE)
             await processing_msg.edit_text(
                 f"❌ **Error occurred**\n\n{str(e)[:100]}...",
                 parse_mode="Markdown",
@@ -2033,10 +4514,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         processing_msg = await update.message.reply_text(get_text(context, "translating"))
 
         try:
-            translated = GoogleTranslator(
-                source=convert_lang_code_for_translation(src),
-                target=convert_lang_code_for_translation(tgt)
-            ).translate(original_text)
+            state = await load_user_state(context, update.effective_user.id)
+            translated, _ = await translate_for_user(context, original_text, src, tgt, state)
            
             src_display = get_lang_display_name(src) if src != "auto" else get_text(context, "auto_detect")
             tgt_display = get_lang_display_name(tgt)
@@ -2049,8 +4528,10 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 {get_text(context, "to_label", tgt_lang=tgt_display)}
 {translated}"""
 
-            await processing_msg.edit_text(result_text, parse_mode="Markdown", reply_markup=get_back_button(context))
+            await send_long_text(processing_msg, result_text, parse_mode="Markdown", reply_markup=get_back_button(context), edit=True)
            
+        except CircuitOpenError:
+            await processing_msg.edit_text(get_text(context, "service_busy"), parse_mode="Markdown", reply_markup=get_back_button(context))
         except Exception as e:
             await processing_msg.edit_text(get_text(context, "translation_error", error=str(e)), reply_markup=get_back_button(context))
        
@@ -2066,12 +4547,20 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
 # Helper: clone user's voice using ElevenLabs
-async def clone_user_voice(user_id: int, audio_file_path: str, source_language: str = None):
+def encode_clone_sample(audio: AudioSegment) -> bytes:
+    """Кодирует образец голоса в MP3 прямо в память (CPU-bound, вызывать в audio_executor)."""
+    buf = BytesIO()
+    audio.export(buf, format="mp3")
+    return buf.getvalue()
+
+
+async def clone_user_voice(user_id: int, sample: bytes, source_language: str = None):
+    """Клонирует голос из MP3-байтов. Возвращает voice_id или None."""
     if not ELEVENLABS_API_KEY:
         print("ElevenLabs API key is missing.")
         return None
 
-    headers = {"xi-api-key": ELEVENLABS_API_KEY}
+    headers = elevenlabs_headers()
     voice_name = f"user_{user_id}_voice"
 
     description = f"Cloned voice for user {user_id}"
@@ -2079,34 +4568,124 @@ async def clone_user_voice(user_id: int, audio_file_path: str, source_language:
         lang_name = get_lang_display_name(source_language)
         description += f" - Source: {lang_name}"
 
-    files = {
-        "name": (None, voice_name),
-        "description": (None, description),
-        "files": (os.path.basename(audio_file_path), open(audio_file_path, "rb"), "audio/mpeg"),
+    form = {
+        "name": voice_name,
+        "description": description,
     }
 
+    async def post():
+        # Передаём bytes, а не открытый файл — закрывать нечего
+        resp = await http_client.post(
+            ELEVENLABS_VOICE_CLONE_URL,
+            headers=headers,
+            data=form,
+            files={"files": (f"user_{user_id}_sample.mp3", sample, "audio/mpeg")},
+            timeout=ELEVENLABS_CLONE_TIMEOUT,
+        )
+        if resp.status_code not in (200, 201):
+            raise ElevenLabsError(resp.status_code, resp.text)
+        return resp
+
     try:
-        resp = requests.post(ELEVENLABS_VOICE_CLONE_URL, headers=headers, files=files, timeout=60)
-        if resp.status_code in (200, 201):
-            data = resp.json()
-            voice_id = data.get("voice_id") or data.get("id") or data.get("voice", {}).get("voice_id")
-            print(f"Voice cloned with source language {source_language}: {voice_id}")
-            return voice_id
-        else:
-            print(f"❌ Cloning error: {resp.text}")
-            return None
+        # Клонирование создаёт голос в аккаунте — не повторяем
+        resp = await call_with_resilience("elevenlabs", post, idempotent=False)
+        data = resp.json()
+        voice_id = data.get("voice_id") or data.get("id") or data.get("voice", {}).get("voice_id")
+        print(f"Voice cloned with source language {source_language}: {voice_id}")
+        return voice_id
+    except CircuitOpenError:
+        raise
+    except ElevenLabsError as e:
+        print(f"❌ Cloning error: {e.text}")
+        return None
     except Exception as e:
         print(f"Exception during cloning: {e}")
         return None
+
+# ========== Клонирование: одна попытка на пользователя ==========
+# Два образца подряд не должны создать два голоса в ElevenLabs.
+# В процессе — SingleFlight по user_id, между процессами — advisory lock в Postgres
+# (ключ — сам user_id; других advisory lock'ов в боте нет).
+# Блокировка живёт на соединении из clone_lock_pool; пока ждём — соединение не держим.
+CLONE_LOCK_POLL = float(os.getenv("CLONE_LOCK_POLL", "0.5"))
+CLONE_LOCK_WAIT = float(os.getenv("CLONE_LOCK_WAIT", str(ELEVENLABS_CLONE_TIMEOUT + 30)))
+
+clone_flight = SingleFlight()
+
+
+class CloneLockTimeout(Exception):
+    """Не дождались advisory lock клонирования (другой процесс завис)."""
+
+
+async def _acquire_clone_lock(user_id: int):
+    """Ждёт advisory lock клонирования и возвращает соединение, которое его держит."""
+    if clone_lock_pool is None:
+        raise RuntimeError("Clone lock pool is not initialized (init_db() not called)")
+
+    deadline = time.monotonic() + CLONE_LOCK_WAIT
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise CloneLockTimeout(f"voice clone lock for {user_id}")
+        try:
+            conn = await clone_lock_pool.acquire(timeout=remaining)
+        except asyncio.TimeoutError:
+            raise CloneLockTimeout(f"voice clone lock pool for {user_id}")
+        try:
+            locked = await queries.fetchval(conn, "clone_lock_try", user_id)
+        except BaseException:
+            await clone_lock_pool.release(conn)
+            raise
+        if locked:
+            return conn
+        # Занято другим процессом — отдаём соединение и ждём
+        await clone_lock_pool.release(conn)
+        await asyncio.sleep(CLONE_LOCK_POLL)
+
+
+async def _clone_voice_locked(user_id: int, sample: bytes, src: str, tgt: str, premium: bool):
+    conn = await _acquire_clone_lock(user_id)
+    try:
+        # Пока ждали, другой процесс мог уже склонировать голос
+        row = await queries.fetchrow(conn, "get_cloned_voice", user_id)
+        if row:
+            print(f"♻️ Reusing voice cloned concurrently for user {user_id}: {row['voice_id']}")
+            return row["voice_id"], False
+
+        async with schedulers["elevenlabs"].slot(user_id, premium):
+            voice_id = await clone_user_voice(user_id, sample, src)
+
+        if voice_id:
+            # Сохраняем до снятия блокировки, чтобы следующий ждущий увидел голос
+            await queries.execute(conn, "save_cloned_voice", user_id, voice_id, src, tgt)
+            await notify_cache_invalidation(conn, "voice", [user_id])
+        return voice_id, True
     finally:
-        # Закрываем файл если он открыт
-        if 'files' in locals() and 'files' in files:
-            try:
-                files['files'][1].close()
-            except:
-                pass
+        try:
+            await queries.execute(conn, "clone_unlock", user_id)
+        finally:
+            # Если unlock не прошёл, сброс соединения в пуле всё равно снимет блокировку
+            await clone_lock_pool.release(conn)
+
+
+async def clone_voice_once(user_id: int, sample: bytes, src: str, tgt: str, premium: bool = False):
+    """Клонирует голос не более одного раза одновременно для пользователя.
+
+    Возвращает (voice_id, created). created=False — голос создал параллельный
+    запрос (в этом или другом процессе), и мы переиспользуем его voice_id.
+    """
+    leader = False
+
+    async def run():
+        nonlocal leader
+        leader = True
+        return await _clone_voice_locked(user_id, sample, src, tgt, premium)
+
+    voice_id, created = await clone_flight.do(user_id, run)
+    # run() выполняется только у первого запроса; остальные голос не создавали
+    return voice_id, created and leader
+
 
-# Handle voice messages
 # Handle voice messages
 async def handle_premium_plans(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -2202,6 +4781,7 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Показываем статус обработки
     processing_msg = await update.message.reply_text(get_text(context, "processing_voice"))
+    state = await load_user_state(context, update.effective_user.id)
 
     # Download voice file
     voice = await update.message.voice.get_file()
@@ -2230,6 +4810,8 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         with sr.AudioFile(wav_io) as source:
             audio_data = recognizer.record(source)
+            # Подсказываем язык, только если пользователь выбрал его сам: язык
+            # прошлого сообщения в авто-режиме ломает переключение языков
             recog_lang = None if src == "auto" else src
             
             if recog_lang and "-" in recog_lang:
@@ -2239,10 +4821,9 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 sr_lang = None
 
-            if sr_lang:
-                text = recognizer.recognize_google(audio_data, language=sr_lang)
-            else:
-                text = recognizer.recognize_google(audio_data)
+            text = await recognize_speech(
+                audio_data, sr_lang, user_id=state["user_id"], premium=state["is_premium"]
+            )
                 
     except sr.UnknownValueError:
         await processing_msg.edit_text(
@@ -2251,6 +4832,13 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=get_back_button(context)
         )
         return
+    except CircuitOpenError:
+        await processing_msg.edit_text(
+            get_text(context, "service_busy"),
+            parse_mode="Markdown",
+            reply_markup=get_back_button(context)
+        )
+        return
     except Exception as e:
         await processing_msg.edit_text(
             get_text(context, "recognition_error", error=str(e)), 
@@ -2261,11 +4849,14 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Translate
     try:
         await processing_msg.edit_text(get_text(context, "translating"))
-        src_for_translation = "auto" if src == "auto" else convert_lang_code_for_translation(src)
-        translated = GoogleTranslator(
-            source=src_for_translation, 
-            target=convert_lang_code_for_translation(tgt)
-        ).translate(text)
+        translated, translation_skipped = await translate_for_user(context, text, src, tgt, state)
+    except CircuitOpenError:
+        await processing_msg.edit_text(
+            get_text(context, "service_busy"),
+            parse_mode="Markdown",
+            reply_markup=get_back_button(context)
+        )
+        return
     except Exception as e:
         await processing_msg.edit_text(
             get_text(context, "translation_error", error=str(e)), 
@@ -2287,7 +4878,17 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 {get_text(context, "translated", tgt_lang=tgt_display)}
 {translated}"""
 
-            await processing_msg.edit_text(result_text, parse_mode="Markdown", reply_markup=get_back_button(context))
+            await send_long_text(processing_msg, result_text, parse_mode="Markdown", reply_markup=get_back_button(context), edit=True)
+
+        elif mode == "mode_voice_tts" and translation_skipped:
+            # Речь уже на целевом языке — озвучивать тот же текст незачем
+            await send_long_text(
+                processing_msg,
+                get_text(context, "already_target_lang", tgt_lang=tgt_display) + f"\n\n{text}",
+                parse_mode="Markdown",
+                reply_markup=get_back_button(context),
+                edit=True,
+            )
 
         elif mode == "mode_voice_tts":
             await processing_msg.edit_text(get_text(context, "generating_voice"))
@@ -2306,16 +4907,21 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     tts = gTTS(translated, lang="en", tld="co.uk")
                 else:
                     tts = gTTS(translated, lang=base_lang)    
-            with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp_file:
-                tts.save(tmp_file.name)
-                tmp_file_path = tmp_file.name
+
+            # gTTS пишет прямо в память; одинаковая фраза даёт одинаковые байты,
+            # поэтому повторная отправка уходит по file_id
+            def render_tts():
+                buf = BytesIO()
+                tts.write_to_fp(buf)
+                return buf.getvalue()
+
+            audio_bytes = await to_voice_note(await asyncio.to_thread(render_tts))
 
             # Удаляем processing message и отправляем результат
             await processing_msg.delete()
             
             caption = get_text(context, "voice_caption", src_lang=src_display, tgt_lang=tgt_display)
-            with open(tmp_file_path, "rb") as audio_file:
-                await update.message.reply_voice(voice=audio_file, caption=caption, reply_markup=None)
+            await send_voice_artifact(update.message, audio_bytes, caption=caption, reply_markup=None, reusable=True)
                 
             # Отправляем текст отдельно если он длинный
             if len(text) > 100 or len(translated) > 100:
@@ -2324,9 +4930,7 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 {get_text(context, "original", text=text)}
 
 {get_text(context, "translated_text", text=translated)}"""
-                await update.message.reply_text(details, parse_mode="Markdown")
-
-            os.remove(tmp_file_path)
+                await send_long_text(update.message, details, parse_mode="Markdown")
 
         elif mode == "mode_voice_clone":
             # Проверяем язык источника
@@ -2338,13 +4942,9 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
             
-            # 🆕 ИСПРАВЛЕНО: Используем новую функцию проверки клонирования
+            # Проверяем и списываем попытку клонирования (премиум — без лимитов)
             user_id = update.effective_user.id
-            # Премиум = пропускаем лимиты НАВСЕГДА
-            if context.user_data.get("is_premium", False):
-                can_use = True
-            else:
-                can_use, limit_msg = check_voice_cloning_limit(context, user_id)
+            can_use, limit_msg = await try_consume_quota(context, user_id, QUOTA_VOICE_CLONING)
             
             if not can_use:
                 await processing_msg.edit_text(
@@ -2354,12 +4954,10 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
                 
-            db_voice = await get_cloned_voice(user_id)
-            if db_voice:
-                existing = db_voice["voice_id"]
+            state = await load_user_state(context, user_id)
+            existing = state["voice_id"]
+            if existing:
                 context.user_data["cloned_voice_id"] = existing
-            else:
-                existing = None
 
             
             if existing:
@@ -2370,6 +4968,7 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Нужно клонировать голос
                 duration_sec = len(audio) / 1000.0
                 if duration_sec < 30:
+                    await release_quota(context, user_id, QUOTA_VOICE_CLONING)
                     await processing_msg.edit_text(
                         get_text(context, "need_longer_audio", duration=duration_sec),
                         parse_mode="Markdown",
@@ -2379,25 +4978,42 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 await processing_msg.edit_text(get_text(context, "cloning_voice"))
                 
-                with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp_mp3:
-                    audio.export(tmp_mp3.name, format="mp3")
-                    mp3_path = tmp_mp3.name
+                # Кодируем образец один раз в память, без временных файлов на диске
+                sample = await asyncio.get_running_loop().run_in_executor(
+                    audio_executor, encode_clone_sample, audio
+                )
 
-                voice_id = await clone_user_voice(user_id, mp3_path, src)
-                
-                if os.path.exists(mp3_path):
-                    os.remove(mp3_path)
+                try:
+                    voice_id, created = await clone_voice_once(
+                        user_id, sample, src, tgt, premium=state["is_premium"]
+                    )
+                except CircuitOpenError:
+                    await release_quota(context, user_id, QUOTA_VOICE_CLONING)
+                    await processing_msg.edit_text(
+                        get_text(context, "service_busy"),
+                        parse_mode="Markdown",
+                        reply_markup=get_back_button(context)
+                    )
+                    return
+                except CloneLockTimeout as e:
+                    print(f"⚠️ {e}")
+                    voice_id, created = None, False
+                except Exception:
+                    # Неожиданная ошибка (БД, сеть) — попытку не списываем
+                    await release_quota(context, user_id, QUOTA_VOICE_CLONING)
+                    raise
 
+                if voice_id and not created:
+                    # Голос создал параллельный запрос — попытку не списываем
+                    await release_quota(context, user_id, QUOTA_VOICE_CLONING)
 
-            if voice_id:
-                increment_voice_cloning_count(context)
 
+            if voice_id:
                 # 🆕 Сохраняем voice_id в RAM (context)
                 context.user_data["cloned_voice_id"] = voice_id
 
-                # 🆕 Сохраняем voice_id в PostgreSQL
-                await save_cloned_voice(user_id, voice_id, src, tgt)
-                print(f"💾 Saved cloned voice for user {user_id}: {voice_id}")
+                # В PostgreSQL voice_id уже сохранён под блокировкой клонирования
+                state["voice_id"] = voice_id
 
                 # Обновляем или удаляем processing message
                 try:
@@ -2407,35 +5023,33 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await processing_msg.delete()
                     processing_msg = await update.message.reply_text(get_text(context, "generating_cloned"))
                             
-                synth_url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
-                headers = {"xi-api-key": ELEVENLABS_API_KEY, "Content-Type": "application/json"}
-                
-                payload = {
-                    "text": translated, 
-                    "model_id": "eleven_multilingual_v2",
-                    "voice_settings": {
-                        "stability": 0.5, 
-                        "similarity_boost": 0.75
-                    }
-                }
-                
+                voice_settings = dict(DEFAULT_VOICE_SETTINGS)
                 if tgt in ["zh-CN", "zh-TW"]:
-                    payload["voice_settings"]["style"] = 0.2
-                    payload["voice_settings"]["use_speaker_boost"] = True
+                    voice_settings["style"] = 0.2
+                    voice_settings["use_speaker_boost"] = True
                 
                 print(f"Using voice_id: {voice_id} for synthesis")
-                print(f"Payload: {payload}")
+                print(f"Voice settings: {voice_settings}")
                 
-                r = requests.post(synth_url, headers=headers, json=payload)
-                print(f"ElevenLabs response status: {r.status_code}")
+                try:
+                    audio_bytes = await synthesize_long_text(
+                        voice_id, translated, voice_settings,
+                        user_id=user_id, premium=state["is_premium"],
+                    )
+                    synth_error = None
+                except ElevenLabsError as e:
+                    audio_bytes = None
+                    synth_error = e.text
+                except CircuitOpenError:
+                    await processing_msg.edit_text(
+                        get_text(context, "service_busy"),
+                        parse_mode="Markdown",
+                        reply_markup=get_back_button(context)
+                    )
+                    return
+                print(f"ElevenLabs synthesis ok: {synth_error is None}")
                 
-                if r.status_code == 200:
-                    tmp_out = tempfile.NamedTemporaryFile(suffix=".mp3", delete=False)
-                    tmp_out.write(r.content)
-                    tmp_out.flush()
-                    tmp_out_path = tmp_out.name
-                    tmp_out.close()
-
+                if audio_bytes is not None:
                     # Удаляем processing message
                     try:
                         await processing_msg.delete()
@@ -2444,28 +5058,26 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                     # Отправляем результат
                     caption = get_text(context, "cloned_voice_caption", src_lang=src_display, tgt_lang=tgt_display)
-                    with open(tmp_out_path, "rb") as af:
-                        await update.message.reply_voice(voice=af, caption=caption, reply_markup=None)
+                    await send_voice_artifact(update.message, audio_bytes, caption=caption, reply_markup=None)
                     
                     # Детали отдельно если текст длинный
                     info_text = f"""{get_text(context, "original", text=text)}
 
 {get_text(context, "translated_text", text=translated)}"""
                     if len(info_text) > 500:
-                        await update.message.reply_text(info_text, parse_mode="Markdown")
+                        await send_long_text(update.message, info_text, parse_mode="Markdown")
                     
                     # Отправляем новое меню для удобства
                     await safe_send_menu(update.message, context, is_query=False)
-
-                    os.remove(tmp_out_path)
                 else:
-                    print(f"ElevenLabs error response: {r.text}")
+                    print(f"ElevenLabs error response: {synth_error}")
                     await processing_msg.edit_text(
-                        get_text(context, "voice_synthesis_failed", error=r.text), 
+                        get_text(context, "voice_synthesis_failed", error=synth_error), 
                         parse_mode="Markdown", 
                         reply_markup=get_back_button(context)
                     )
             else:
+                await release_quota(context, user_id, QUOTA_VOICE_CLONING)
                 await processing_msg.edit_text(
                     get_text(context, "voice_cloning_failed"), 
                     parse_mode="Markdown", 
@@ -2484,14 +5096,9 @@ async def preload_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_id = user.id
 
-    # Загружаем премиум-статус из базы
-    is_premium_user = await is_premium(user_id)
-
-    # Сохраняем в RAM
-    context.user_data["is_premium"] = is_premium_user
-
-    # Загружаем другие данные, если надо
-    # cloned_voice_id, lang settings, etc — по желанию        
+    # Загружаем premium и cloned voice одним запросом и сохраняем в RAM.
+    # Остальные хендлеры этого апдейта берут результат из context.user_state
+    await sync_user_state(context, user_id)
 
 def get_user_country_by_ip():
     """Определяет страну пользователя по IP адресу"""
@@ -2613,12 +5220,45 @@ if __name__ == "__main__":
 
     @app_fastapi.on_event("startup")
     async def startup():
+        # Пул БД нужен раньше любых апдейтов
+        await init_db()
         await application.initialize()
         await application.bot.set_webhook(WEBHOOK_URL)
         await application.start()
-        await init_db()
+
+        # Прогреваем соединение к ElevenLabs
+        await warm_up_http_client()
+        # Профили langdetect грузятся при первом вызове — делаем это заранее
+        await asyncio.to_thread(detect_language, "warm up language detection profiles")
+
+        # Сброс кешей по NOTIFY от других воркеров
+        await cache_listener.start()
+
+        # Окончание Premium — точно по access_expires_at + редкая сверка
+        await premium_expiry.start(application.job_queue)
+        application.job_queue.run_repeating(
+            check_expired_premium_job,
+            interval=PREMIUM_RECONCILE_INTERVAL,
+            first=0,  # сразу после старта: подобрать всё, что истекло, пока бот лежал
+            name="premium_reconcile",
+        )
         print("🌐 Telegram webhook initialized")
 
+    @app_fastapi.on_event("shutdown")
+    async def shutdown():
+        # stop() делает последний update_persistence, shutdown() — flush()
+        await application.stop()
+        await application.shutdown()
+        await cache_listener.stop()
+        await http_client.aclose()
+        audio_executor.shutdown(wait=False)
+        translation_executor.shutdown()
+        if clone_lock_pool is not None:
+            await clone_lock_pool.close()
+        if db_pool is not None:
+            await db_pool.close()
+        print("👋 Telegram application stopped")
+
     # Webhook endpoint (очень важно!)
     @app_fastapi.post("/telegram")
     async def telegram_webhook(request: Request):
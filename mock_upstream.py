@@ -0,0 +1,258 @@
+"""Локальная заглушка ElevenLabs / Google Translate / Google Speech для нагрузочных тестов.
+
+Запуск:
+    python mock_upstream.py
+
+Бот направляется на заглушку переменными окружения:
+    ELEVENLABS_API_BASE=http://127.0.0.1:8900
+    ELEVEN_API_KEY=mock
+    GOOGLE_TRANSLATE_URL=http://127.0.0.1:8900/translate/m
+    GOOGLE_SPEECH_URL=http://127.0.0.1:8900/speech-api/v2/recognize
+
+Задержки задаются распределением в формате "вид:параметры" (миллисекунды):
+    const:200            — всегда 200 мс
+    uniform:100:800      — равномерно от 100 до 800 мс
+    normal:400:100       — нормальное, среднее 400, сигма 100
+    lognormal:400:0.5    — логнормальное с медианой 400 и сигмой 0.5 (длинный хвост)
+
+Для каждого бэкенда (TTS, CLONE, TRANSLATE, SPEECH):
+    MOCK_<BACKEND>_LATENCY      — распределение задержки
+    MOCK_<BACKEND>_ERROR_RATE   — доля ответов с ошибкой (0..1)
+    MOCK_<BACKEND>_ERROR_STATUS — код ошибки (по умолчанию 500)
+"""
+
+import os
+import io
+import re
+import json
+import html
+import math
+import uuid
+import random
+import asyncio
+from functools import lru_cache
+
+import uvicorn
+from fastapi import FastAPI, Request, Form, UploadFile, File
+from fastapi.responses import JSONResponse, Response, StreamingResponse, HTMLResponse, PlainTextResponse
+from pydub import AudioSegment
+
+MOCK_HOST = os.getenv("MOCK_HOST", "127.0.0.1")
+MOCK_PORT = int(os.getenv("MOCK_PORT", "8900"))
+
+# Готовый аудиофайл вместо сгенерированной тишины (mp3 или ogg)
+MOCK_TTS_AUDIO = os.getenv("MOCK_TTS_AUDIO")
+# Длительность сгенерированного аудио на символ текста
+MOCK_MS_PER_CHAR = float(os.getenv("MOCK_MS_PER_CHAR", "60"))
+MOCK_STREAM_CHUNK = int(os.getenv("MOCK_STREAM_CHUNK", "4096"))
+MOCK_SPEECH_TRANSCRIPT = os.getenv("MOCK_SPEECH_TRANSCRIPT", "hello this is a load test")
+MOCK_TRANSLATE_PREFIX = os.getenv("MOCK_TRANSLATE_PREFIX", "[{tl}] ")
+# Метки батча бота ("[0] текст") переводчик возвращает как есть — префикс ставим после них
+BATCH_MARK_RE = re.compile(r"^(\s*\[\s*\d+\s*\]\s?)(.*)$")
+
+BACKENDS = ("TTS", "CLONE", "TRANSLATE", "SPEECH")
+DEFAULT_LATENCY = {
+    "TTS": "lognormal:1500:0.4",
+    "CLONE": "lognormal:4000:0.3",
+    "TRANSLATE": "lognormal:250:0.5",
+    "SPEECH": "lognormal:800:0.4",
+}
+
+
+# ========== Распределения задержек ==========
+def parse_latency(spec: str):
+    """Строка "вид:параметры" -> функция без аргументов, возвращающая задержку в секундах."""
+    kind, *args = spec.split(":")
+    params = [float(a) for a in args]
+
+    if kind == "const":
+        (ms,) = params
+        return lambda: ms / 1000
+    if kind == "uniform":
+        low, high = params
+        return lambda: random.uniform(low, high) / 1000
+    if kind == "normal":
+        mean, std = params
+        return lambda: max(0.0, random.gauss(mean, std)) / 1000
+    if kind == "lognormal":
+        median, sigma = params
+        mu = math.log(median)
+        return lambda: random.lognormvariate(mu, sigma) / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class BackendProfile:
+    """Задержка, доля ошибок и счётчики одного поддельного бэкенда."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latency_spec = os.getenv(f"MOCK_{name}_LATENCY", DEFAULT_LATENCY[name])
+        self.latency = parse_latency(self.latency_spec)
+        self.error_rate = float(os.getenv(f"MOCK_{name}_ERROR_RATE", "0"))
+        self.error_status = int(os.getenv(f"MOCK_{name}_ERROR_STATUS", "500"))
+        self.requests = 0
+        self.errors = 0
+
+    async def delay(self, fraction: float = 1.0):
+        await asyncio.sleep(self.latency() * fraction)
+
+    def should_fail(self) -> bool:
+        self.requests += 1
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "latency": self.latency_spec,
+            "error_rate": self.error_rate,
+            "error_status": self.error_status,
+            "requests": self.requests,
+            "errors": self.errors,
+        }
+
+
+profiles = {name: BackendProfile(name) for name in BACKENDS}
+
+
+# ========== Аудио ==========
+@lru_cache(maxsize=None)
+def _canned_audio() -> bytes:
+    with open(MOCK_TTS_AUDIO, "rb") as f:
+        return f.read()
+
+
+@lru_cache(maxsize=64)
+def _silence(seconds: int, opus: bool) -> bytes:
+    out = io.BytesIO()
+    segment = AudioSegment.silent(duration=seconds * 1000)
+    if opus:
+        segment.export(out, format="ogg", codec="libopus", bitrate="32k")
+    else:
+        segment.export(out, format="mp3", bitrate="64k")
+    return out.getvalue()
+
+
+def render_audio(text: str, output_format: str = None) -> bytes:
+    if MOCK_TTS_AUDIO:
+        return _canned_audio()
+    seconds = max(1, math.ceil(len(text) * MOCK_MS_PER_CHAR / 1000))
+    return _silence(seconds, bool(output_format and output_format.startswith("opus")))
+
+
+app = FastAPI(title="Mock upstream")
+
+
+def error_response(profile: BackendProfile):
+    return JSONResponse({"detail": {"status": "mock_error", "message": f"{profile.name} failure"}},
+                        status_code=profile.error_status)
+
+
+# ========== ElevenLabs ==========
+@app.get("/v1/models")
+async def models():
+    return [{"model_id": "eleven_multilingual_v2", "name": "Mock Multilingual v2"}]
+
+
+@app.post("/v1/voices/add")
+async def add_voice(name: str = Form(...), description: str = Form(""), files: list[UploadFile] = File(...)):
+    profile = profiles["CLONE"]
+    # Читаем загрузку целиком, как настоящий сервер
+    size = 0
+    for upload in files:
+        size += len(await upload.read())
+    await profile.delay()
+    if profile.should_fail():
+        return error_response(profile)
+    voice_id = f"mock_{uuid.uuid4().hex[:20]}"
+    print(f"🎤 Mock clone {name}: {size} bytes -> {voice_id}")
+    return {"voice_id": voice_id}
+
+
+@app.post("/v1/text-to-speech/{voice_id}")
+async def text_to_speech(voice_id: str, request: Request, output_format: str = None):
+    profile = profiles["TTS"]
+    payload = await request.json()
+    await profile.delay()
+    if profile.should_fail():
+        return error_response(profile)
+    audio = render_audio(payload.get("text", ""), output_format)
+    media_type = "audio/ogg" if audio[:4] == b"OggS" else "audio/mpeg"
+    return Response(audio, media_type=media_type)
+
+
+@app.post("/v1/text-to-speech/{voice_id}/stream")
+async def text_to_speech_stream(voice_id: str, request: Request, output_format: str = None):
+    profile = profiles["TTS"]
+    payload = await request.json()
+    # Первый байт — после трети задержки, остальное растянуто по чанкам
+    await profile.delay(1 / 3)
+    if profile.should_fail():
+        return error_response(profile)
+    audio = render_audio(payload.get("text", ""), output_format)
+    media_type = "audio/ogg" if audio[:4] == b"OggS" else "audio/mpeg"
+    chunks = [audio[i:i + MOCK_STREAM_CHUNK] for i in range(0, len(audio), MOCK_STREAM_CHUNK)]
+    rest = profile.latency() * 2 / 3
+
+    async def body():
+        for chunk in chunks:
+            yield chunk
+            await asyncio.sleep(rest / len(chunks))
+
+    return StreamingResponse(body(), media_type=media_type)
+
+
+# ========== Google Translate (HTML-страница, которую парсит deep-translator) ==========
+def fake_translate(text: str, sl: str, tl: str) -> str:
+    """Префикс в начале каждой непустой строки, после метки батча, если она есть."""
+    prefix = MOCK_TRANSLATE_PREFIX.format(sl=sl, tl=tl)
+    lines = []
+    for line in text.split("\n"):
+        if not line.strip():
+            lines.append(line)
+            continue
+        match = BATCH_MARK_RE.match(line)
+        if match:
+            lines.append(match.group(1) + prefix + match.group(2))
+        else:
+            lines.append(prefix + line)
+    return "\n".join(lines)
+
+
+@app.get("/translate/m")
+async def translate_page(q: str = "", sl: str = "auto", tl: str = "en"):
+    profile = profiles["TRANSLATE"]
+    await profile.delay()
+    if profile.should_fail():
+        return PlainTextResponse("mock error", status_code=profile.error_status)
+    translated = fake_translate(q, sl, tl)
+    return HTMLResponse(
+        f'<html><body><div class="result-container t0">{html.escape(translated)}</div></body></html>'
+    )
+
+
+# ========== Google Speech API v2 (формат ответа recognize_google) ==========
+@app.post("/speech-api/v2/recognize")
+async def recognize(request: Request):
+    profile = profiles["SPEECH"]
+    await request.body()
+    await profile.delay()
+    if profile.should_fail():
+        return PlainTextResponse("mock error", status_code=profile.error_status)
+    result = {
+        "result": [{"alternative": [{"transcript": MOCK_SPEECH_TRANSCRIPT, "confidence": 0.92}], "final": True}],
+        "result_index": 0,
+    }
+    return PlainTextResponse('{"result":[]}\n' + json.dumps(result) + "\n", media_type="application/json")
+
+
+@app.get("/mock/stats")
+async def stats():
+    return {name: profile.stats() for name, profile in profiles.items()}
+
+
+if __name__ == "__main__":
+    for name, profile in profiles.items():
+        print(f"🧪 {name}: latency={profile.latency_spec} error_rate={profile.error_rate}")
+    uvicorn.run(app, host=MOCK_HOST, port=MOCK_PORT)
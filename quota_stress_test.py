@@ -0,0 +1,112 @@
+"""Проверка атомарности бесплатных лимитов под конкурентной нагрузкой.
+
+Запускает N одновременных consume_quota для одного пользователя и проверяет,
+что успешных ровно limit — ни одной лишней попытки. Затем так же параллельно
+возвращает попытки через refund_quota и проверяет, что used не ушёл ниже нуля.
+
+Запуск только на тестовой БД (таблицы создаст init_db):
+    DATABASE_URL=postgresql://localhost/bot_test python quota_stress_test.py
+
+Переменные окружения:
+    STRESS_REQUESTS — одновременных вызовов за раунд (по умолчанию 200)
+    STRESS_LIMIT    — лимит попыток (по умолчанию 3)
+    STRESS_ROUNDS   — число раундов (по умолчанию 5)
+    STRESS_USER_ID  — тестовый user_id (по умолчанию -1, реальные id положительные)
+    DB_POOL_MAX_SIZE — размер пула, т.е. сколько запросов реально идут параллельно
+"""
+
+import os
+import sys
+import time
+import asyncio
+
+# main собирает Application при импорте — токен нужен, но к Telegram не ходим
+os.environ.setdefault("TELEGRAM_TOKEN", "0:quota-stress-test")
+
+import main  # noqa: E402
+
+STRESS_REQUESTS = int(os.getenv("STRESS_REQUESTS", "200"))
+STRESS_LIMIT = int(os.getenv("STRESS_LIMIT", "3"))
+STRESS_ROUNDS = int(os.getenv("STRESS_ROUNDS", "5"))
+STRESS_USER_ID = int(os.getenv("STRESS_USER_ID", "-1"))
+STRESS_FEATURE = "stress_test"
+
+
+async def reset_quota():
+    async with main.db_conn() as conn:
+        await conn.execute(
+            "DELETE FROM usage_quotas WHERE user_id = $1 AND feature = $2;",
+            STRESS_USER_ID, STRESS_FEATURE,
+        )
+
+
+async def used_in_db() -> int:
+    async with main.db_conn() as conn:
+        return await conn.fetchval(
+            "SELECT used FROM usage_quotas WHERE user_id = $1 AND feature = $2;",
+            STRESS_USER_ID, STRESS_FEATURE,
+        )
+
+
+async def run_round(number: int) -> list:
+    """Один раунд; возвращает список нарушений (пустой — всё хорошо)."""
+    await reset_quota()
+    errors = []
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[
+        main.consume_quota(STRESS_USER_ID, STRESS_FEATURE, STRESS_LIMIT)
+        for _ in range(STRESS_REQUESTS)
+    ])
+    consume_ms = (time.perf_counter() - started) * 1000
+
+    granted = sorted(r for r in results if r is not None)
+    if granted != list(range(1, STRESS_LIMIT + 1)):
+        errors.append(f"consume: granted {granted}, expected 1..{STRESS_LIMIT}")
+    used = await used_in_db()
+    if used != STRESS_LIMIT:
+        errors.append(f"consume: used={used} in DB, expected {STRESS_LIMIT}")
+
+    refunds = await asyncio.gather(*[
+        main.refund_quota(STRESS_USER_ID, STRESS_FEATURE)
+        for _ in range(STRESS_REQUESTS)
+    ])
+    refunded = sum(1 for r in refunds if r is not None)
+    if refunded != STRESS_LIMIT:
+        errors.append(f"refund: {refunded} refunds succeeded, expected {STRESS_LIMIT}")
+    used = await used_in_db()
+    if used != 0:
+        errors.append(f"refund: used={used} in DB, expected 0")
+
+    status = "✅" if not errors else "❌"
+    print(f"{status} Round {number}: {len(granted)}/{STRESS_REQUESTS} granted, "
+          f"{refunded} refunded, consume took {consume_ms:.1f} ms")
+    return errors
+
+
+async def run():
+    if not main.DATABASE_URL:
+        print("❌ DATABASE_URL is not set — point it at a test database")
+        return 2
+
+    await main.init_db()
+    failures = []
+    try:
+        for number in range(1, STRESS_ROUNDS + 1):
+            failures.extend(await run_round(number))
+    finally:
+        await reset_quota()
+        await main.clone_lock_pool.close()
+        await main.db_pool.close()
+
+    for error in failures:
+        print(f"❌ {error}")
+    if failures:
+        return 1
+    print(f"✅ consume_quota held the limit of {STRESS_LIMIT} under "
+          f"{STRESS_REQUESTS} concurrent calls in {STRESS_ROUNDS} rounds")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run()))